@@ -11,14 +11,22 @@ import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
 from elasticsearch import Elasticsearch
+from redis import Redis
 from app.errors import errors_bp
 from app.auth import auth_bp
 from app.main import routes_bp
 from app.api import api_bp
 from .models import db, login, User, Post
-from .email import mail
-from .cli import translate_bp
-from .translate import translate
+from .email import mail, mail_queue
+from .presence import last_seen
+from .hashing import password_hasher
+from . import etags
+from .jsonprovider import init_json
+from .search import init_search, ResultCache
+from .pubsub import init_broker, StreamLimiter
+from .tokencache import TokenCache
+from .cli import translate_bp, counters_bp, search_bp, posts_bp
+from .translate import translate, init_translator
 from celery import Celery, Task
 
 
@@ -55,22 +63,46 @@ def create_app(test_config=None):
         app.config.from_object(Config)
     else:
         app.config.from_object(test_config)
+    init_json(app)
     # Initialize extensions
     db.init_app(app)
     migrate.init_app(app, db)
     moment.init_app(app)
     mail.init_app(app)
+    mail_queue.init_app(app)
     login.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
+    last_seen.init_app(app)
+    password_hasher.init_app(app)
+    etags.init_app(app)
     # Register blueprints
     app.register_blueprint(routes_bp)
     app.register_blueprint(errors_bp)
     app.register_blueprint(auth_bp)
     app.register_blueprint(translate_bp)
+    app.register_blueprint(counters_bp)
+    app.register_blueprint(search_bp)
+    app.register_blueprint(posts_bp)
     app.register_blueprint(api_bp)
     # Initialize Elasticsearch
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
         if app.config['ELASTICSEARCH_URL'] else None
+    app.search = init_search(app)
+    app.search_cache = ResultCache(app.config['SEARCH_CACHE_SIZE'],
+                                   app.config['SEARCH_CACHE_TTL'])
+    # Initialize the translator and its cache
+    app.translator = init_translator(app)
+    app.translation_cache = ResultCache(app.config['TRANSLATION_CACHE_SIZE'],
+                                        24 * 3600)
+    # Initialize the shared Redis connection
+    app.redis = Redis.from_url(app.config['REDIS_URL']) \
+        if app.config['REDIS_URL'] else None
+    # Initialize the API token cache
+    app.token_cache = TokenCache(app)
+    # Initialize the notification broker
+    app.notification_broker = init_broker(app)
+    app.notification_streams = StreamLimiter(
+        app.config['NOTIFICATIONS_MAX_STREAMS'])
     # Initialize Celery task queue
     celery_app = celery_init_app(app)
     app.task_queue = celery_app.control.inspect()
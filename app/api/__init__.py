@@ -4,6 +4,7 @@ Microblog API blueprint
 
 from flask import Blueprint
 from .users import users_bp
+from .posts import posts_bp
 from .errors import error_bp
 from .tokens import token_bp
 
@@ -13,5 +14,6 @@ api_bp = Blueprint('api', __name__, url_prefix='/api')
 
 # Register the childern blueprints here
 api_bp.register_blueprint(users_bp)
+api_bp.register_blueprint(posts_bp)
 api_bp.register_blueprint(error_bp)
 api_bp.register_blueprint(token_bp)
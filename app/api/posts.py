@@ -0,0 +1,86 @@
+"""
+Post API definitions
+"""
+
+from datetime import datetime, timezone
+from flask import Blueprint, current_app, request
+from app.models import db, Post
+import sqlalchemy as sa
+from .errors import bad_request
+from .auth import token_auth
+
+# This blueprint will be nested into api
+posts_bp = Blueprint('posts', __name__, url_prefix='/posts')
+
+
+def parse_post(item, now):
+    """Return the row for one item of a batch, or an error message."""
+    if not isinstance(item, dict):
+        return None, 'must be an object'
+    body = item.get('body')
+    if not isinstance(body, str) or not body.strip() or len(body) > 140:
+        return None, 'body must be 1 to 140 characters'
+    timestamp = item.get('timestamp')
+    if timestamp is None:
+        return {'body': body, 'timestamp': now}, None
+    try:
+        timestamp = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None, 'timestamp must be an ISO 8601 date'
+    # Imported dates without an offset are taken to be UTC
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return {'body': body, 'timestamp': timestamp.astimezone(timezone.utc)}, \
+        None
+
+
+@posts_bp.route('/batch', methods=['POST'])
+@token_auth.login_required
+def create_posts():
+    """Create many posts for the caller, e.g. when importing them.
+
+    Posts are inserted and committed in chunks; their languages and the
+    followers' timelines are filled in by workers afterwards, through the
+    outbox. Every item
+    gets its own status, 201 with the new id or 400 with the reason.
+    """
+    data = request.get_json(silent=True)
+    items = data.get('posts') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return bad_request('must include a non-empty list of posts')
+    limit = current_app.config['POST_BATCH_LIMIT']
+    if len(items) > limit:
+        return bad_request(f'at most {limit} posts per request')
+    user_id = token_auth.current_user().id
+    now = datetime.now(timezone.utc)
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        row, error = parse_post(item, now)
+        if error:
+            results[index] = {'status': 400, 'error': error}
+        else:
+            valid.append((index, row))
+
+    size = current_app.config['POST_BATCH_CHUNK_SIZE']
+    for start in range(0, len(valid), size):
+        chunk = valid[start:start + size]
+        try:
+            ids = Post.insert_many(user_id, [row for _index, row in chunk])
+            # Recorded with the chunk, so a broker outage cannot lose it
+            Post.defer_processing(ids)
+            db.session.commit()
+        except sa.exc.SQLAlchemyError:
+            db.session.rollback()
+            current_app.logger.exception('Could not store a batch of posts')
+            for index, _row in chunk:
+                results[index] = {'status': 500, 'error': 'not stored'}
+            continue
+        for (index, _row), id in zip(chunk, ids):
+            results[index] = {'status': 201, 'id': id}
+
+    created = sum(result['status'] == 201 for result in results)
+    return {
+        'items': results,
+        '_meta': {'created': created, 'failed': len(results) - created}
+    }, 201 if created == len(results) else 207
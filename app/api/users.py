@@ -2,50 +2,118 @@
 User API definitions
 """
 
-from flask import Blueprint, request, url_for, abort
+from flask import (
+    Blueprint, Response, current_app, request, stream_with_context, url_for,
+    abort
+)
 from app.models import db, User
 import sqlalchemy as sa
 from .errors import bad_request
 from .auth import token_auth
+from app.etags import make_etag, conditional
 
 # This blueprint will be nested into api
 users_bp = Blueprint('users', __name__, url_prefix='/users')
 
 
+def parse_fieldset(allow_email=False):
+    """Read the fields= and expand= arguments.
+
+    Returns the set of fields to serialize, or None for the default
+    representation, and an error response if the arguments are invalid.
+    """
+    fields = request.args.get('fields')
+    expand = request.args.get('expand')
+    if not fields and not expand:
+        return None, None
+    fieldset = set(fields.split(',')) if fields else set(User.API_FIELDS)
+    unknown = fieldset - set(User.API_FIELDS)
+    expansions = set(expand.split(',')) if expand else set()
+    unknown |= expansions - set(User.API_EXPANSIONS)
+    if unknown:
+        return None, bad_request(
+            'unknown fields: ' + ', '.join(sorted(unknown)))
+    if 'email' in expansions and not allow_email:
+        return None, bad_request('email can only be expanded on your '
+                                 'own user')
+    return fieldset | expansions, None
+
+
+def collection_response(query, endpoint, fieldset, **kwargs):
+    """Return a page of users as one JSON document, or stream it as
+    NDJSON when the client accepts application/x-ndjson."""
+    per_page = request.args.get('per_page', 10, type=int)
+    after = request.args.get('after')
+    # Carried over into the self, next and prev links
+    kwargs.update(fields=request.args.get('fields'),
+                  expand=request.args.get('expand'))
+    if request.accept_mimetypes.best_match(
+            ['application/json', 'application/x-ndjson']) == \
+            'application/x-ndjson':
+        if request.args.get('before'):
+            return bad_request('streamed collections can only be read '
+                               'forwards')
+        per_page = max(1, min(per_page,
+                              current_app.config['API_STREAM_MAX_PER_PAGE']))
+        return Response(stream_with_context(User.to_collection_stream(
+            query, User.id, per_page, endpoint, after=after,
+            fieldset=fieldset,
+            chunk_size=current_app.config['API_STREAM_CHUNK_SIZE'],
+            **kwargs)), mimetype='application/x-ndjson')
+    return User.to_collection_dict(query, User.id, max(1, min(per_page, 100)),
+                                   endpoint, before=request.args.get('before'),
+                                   after=after, fieldset=fieldset, **kwargs)
+
+
 @users_bp.route('<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
-    return db.get_or_404(User, id).to_dict()
+    fieldset, error = parse_fieldset(
+        allow_email=token_auth.current_user().id == id)
+    if error:
+        return error
+    validators = db.session.execute(
+        sa.select(User.version, User.last_seen).where(User.id == id)).first()
+    if validators is None:
+        abort(404)
+    conditional(make_etag(request.full_path, *validators))
+    if fieldset is None:
+        return db.get_or_404(User, id).to_dict()
+    user = db.first_or_404(sa.select(User).where(User.id == id).options(
+        User.api_load_options(fieldset)))
+    return user.to_dict(fields=fieldset)
 
 
 @users_bp.route('/', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(sa.select(User),
-                                   page, per_page,
-                                   'api.users.get_users')
+    fieldset, error = parse_fieldset()
+    if error:
+        return error
+    return collection_response(sa.select(User), 'api.users.get_users',
+                               fieldset)
 
 
 @users_bp.route('<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
+    fieldset, error = parse_fieldset()
+    if error:
+        return error
     user = db.get_or_404(User, id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(user.followers.select(), page, per_page,
-                                   'api.users.get_followers', id=id)
+    return collection_response(user.followers.select(),
+                               'api.users.get_followers', fieldset, id=id)
 
 
 @users_bp.route('<int:id>/following', methods=['GET'])
 @token_auth.login_required
 def get_following(id):
+    fieldset, error = parse_fieldset()
+    if error:
+        return error
     user = db.get_or_404(User, id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(user.following.select(), page, per_page,
-                                   'api.users.get_following', id=id)
+    return collection_response(user.following.select(),
+                               'api.users.get_following', fieldset, id=id)
 
 
 @users_bp.route('/', methods=['POST'])
@@ -0,0 +1,30 @@
+"""
+background.py
+
+Background threads owned by a single process. Forked workers do not
+inherit threads, so whatever starts them is run lazily, once in each
+process that needs it.
+"""
+
+import os
+import threading
+
+
+class PerProcess(object):
+    """Call ``factory()`` on first use in each process and keep what it
+    returns, e.g. a started thread or an executor."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._pid = None
+
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._value = self._factory()
+                    self._pid = pid
+        return self._value
@@ -2,9 +2,15 @@
 Flask Command-Line Interface custom commands
 """
 
-from flask import Blueprint
+from flask import Blueprint, current_app
 import os
+import time
 import click
+from concurrent.futures import (ProcessPoolExecutor, wait,
+                                FIRST_COMPLETED)
+import sqlalchemy as sa
+from app.models import db, User, Post, SearchableMixin
+from app.language import warm_up, detect_languages
 
 
 # We use Blueprints to register commands
@@ -12,6 +18,18 @@ translate_bp = Blueprint('translate', __name__, cli_group='translate')
 translate_bp.cli.short_help = "Translation and localization commands."
 translate_bp.cli.help = "Translation and localization commands."
 
+counters_bp = Blueprint('counters', __name__, cli_group='counters')
+counters_bp.cli.short_help = "Denormalized counter maintenance."
+counters_bp.cli.help = "Denormalized counter maintenance."
+
+search_bp = Blueprint('search', __name__, cli_group='search')
+search_bp.cli.short_help = "Full-text search index commands."
+search_bp.cli.help = "Full-text search index commands."
+
+posts_bp = Blueprint('posts', __name__, cli_group='posts')
+posts_bp.cli.short_help = "Post maintenance commands."
+posts_bp.cli.help = "Post maintenance commands."
+
 
 @translate_bp.cli.command()
 def update():
@@ -40,3 +58,85 @@ def init(lang):
             'pybabel init -i messages.pot -d app/translations -l ' + lang):
         raise RuntimeError('init command failed')
     os.remove('messages.pot')
+
+
+@counters_bp.cli.command()
+def repair():
+    """Recompute follower, following, post and unread counters."""
+    fixed = User.repair_counters()
+    db.session.commit()
+    click.echo(f'Repaired counters for {fixed} user(s).')
+
+
+@search_bp.cli.command()
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Rows per bulk request.')
+@click.option('--workers', default=4, show_default=True,
+              help='Chunks indexed in parallel.')
+@click.argument('models', nargs=-1)
+def reindex(chunk_size, workers, models):
+    """Rebuild search indexes and swap them in atomically."""
+    if not current_app.search:
+        raise click.ClickException('Search is not configured.')
+    searchable = SearchableMixin.searchable_models()
+    for name in models or searchable:
+        if name not in searchable:
+            raise click.ClickException(f'{name} is not searchable.')
+        start = time.monotonic()
+
+        def progress(done):
+            rate = done / max(time.monotonic() - start, 1e-6)
+            click.echo(f'\r{name}: {done} rows, {rate:.0f} rows/s',
+                       nl=False)
+
+        total = searchable[name].reindex(chunk_size=chunk_size,
+                                         workers=workers, progress=progress)
+        elapsed = time.monotonic() - start
+        click.echo(f'\r{name}: indexed {total} rows in {elapsed:.1f}s '
+                   f'({total / max(elapsed, 1e-6):.0f} rows/s)')
+
+
+@posts_bp.cli.command('detect-language')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Posts per batch.')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True,
+              help='Detector processes.')
+@click.option('--all', 'redetect', is_flag=True,
+              help='Also redo posts that already have a language.')
+def detect_language(batch_size, workers, redetect):
+    """Backfill Post.language in parallel batches."""
+    query = sa.select(Post.id, Post.body).order_by(Post.id).limit(batch_size)
+    if not redetect:
+        query = query.where(Post.language.is_(None))
+
+    def batches():
+        last_id = 0
+        while True:
+            rows = db.session.execute(query.where(Post.id > last_id)).all()
+            db.session.rollback()
+            if not rows:
+                return
+            last_id = rows[-1].id
+            yield [tuple(row) for row in rows]
+
+    done = 0
+    with ProcessPoolExecutor(workers, initializer=warm_up) as pool:
+        pending = set()
+        for batch in batches():
+            # Keep a couple of batches queued per process, no more
+            if len(pending) >= workers * 2:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                done += _store_languages(finished)
+                click.echo(f'{done} posts')
+            pending.add(pool.submit(detect_languages, batch))
+        done += _store_languages(pending)
+    click.echo(f'Detected the language of {done} posts.')
+
+
+def _store_languages(futures):
+    languages = {}
+    for future in futures:
+        languages.update(future.result())
+    Post.set_languages(languages)
+    db.session.commit()
+    return len(languages)
@@ -1,22 +1,142 @@
 """
 email.py
 
-We set up a simple email framework with Flask-Mail
+We set up a simple email framework with Flask-Mail. Asynchronous
+messages go through a bounded queue served by a small pool of worker
+threads; each worker sends whatever has queued up over a single SMTP
+connection before closing it.
 """
 
-from flask import current_app
+import atexit
+import queue
+import threading
+import time
 from flask_mail import Mail, Message
-from threading import Thread
+from .background import PerProcess
 
 
 # Initialize Flask-Email instance
 mail = Mail()
 
 
-# Asynchronous email submission
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class MailQueue(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.queue = None
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency = 0.0
+        self._lock = threading.Lock()
+        self._workers = PerProcess(self._start_workers)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.app is None:
+            atexit.register(self._drain_at_exit)
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        self._workers = PerProcess(self._start_workers)
+        app.extensions['mail_queue'] = self
+
+    def put(self, msg):
+        """Queue a message, waiting briefly for room when the queue is
+        full; returns False if the message had to be dropped."""
+        self._ensure_workers()
+        try:
+            self.queue.put((time.monotonic(), msg),
+                           timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            self.app.logger.error('Mail queue full, dropped %r', msg.subject)
+            return False
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self.queue.qsize(),
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                # Average seconds from queueing to delivery
+                'latency': self.latency / self.sent if self.sent else 0.0
+            }
+
+    def _ensure_workers(self):
+        self._workers.get()
+
+    def _start_workers(self):
+        workers = [
+            threading.Thread(target=self._run, daemon=True,
+                             name=f'mail-worker-{i}')
+            for i in range(self.app.config['MAIL_WORKERS'])
+        ]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            with self.app.app_context():
+                self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        # Keep the connection while messages keep arriving, up to
+        # MAIL_BATCH_SIZE of them
+        limit = self.app.config['MAIL_BATCH_SIZE']
+        started = time.monotonic()
+        latency = 0.0
+        try:
+            with mail.connect() as connection:
+                while batch:
+                    queued, msg = batch.pop()
+                    try:
+                        connection.send(msg)
+                    except Exception:
+                        self._done(failed=1)
+                        raise
+                    waited = time.monotonic() - queued
+                    latency += waited
+                    self._done(sent=1, latency=waited)
+                    limit -= 1
+                    if limit > 0:
+                        try:
+                            batch.append(self.queue.get_nowait())
+                        except queue.Empty:
+                            pass
+            sent = self.app.config['MAIL_BATCH_SIZE'] - limit
+            stats = self.stats()
+            self.app.logger.info(
+                'Sent %d emails in %.3fs, %.3fs after queueing on average; '
+                'queue depth %d, %d sent, %d failed, %d dropped, %.3fs '
+                'average latency', sent, time.monotonic() - started,
+                latency / sent, stats['depth'], stats['sent'],
+                stats['failed'], stats['dropped'], stats['latency'])
+        except Exception:
+            self.app.logger.exception('Could not send email')
+            # Messages already taken off the queue are given up on
+            for _ in batch:
+                self._done(failed=1)
+
+    def _done(self, sent=0, failed=0, latency=0.0):
+        with self._lock:
+            self.sent += sent
+            self.failed += failed
+            self.latency += latency
+        self.queue.task_done()
+
+    def _drain_at_exit(self):
+        # Give queued messages a moment to go out before the process ends
+        deadline = time.monotonic() + 10
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+
+mail_queue = MailQueue()
 
 
 # Simple email submission function
@@ -31,6 +151,4 @@ def send_email(subject, sender, recipients, text_body, html_body,
     if sync:
         mail.send(msg)
     else:
-        Thread(target=send_async_email,
-               args=(current_app._get_current_object(),
-                     msg)).start()
+        mail_queue.put(msg)
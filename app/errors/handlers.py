@@ -38,3 +38,15 @@ def internal_error(error):
     if wants_json_response():
         return api_error_response(500)
     return render_template('errors/500.html'), 500
+
+
+# Password hashing pool is saturated
+@errors_bp.app_errorhandler(503)
+def service_unavailable_error(error):
+    # Keep headers such as Retry-After from the exception
+    headers = [header for header in error.get_headers()
+               if header[0] != 'Content-Type']
+    if wants_json_response():
+        payload, status = api_error_response(503)
+        return payload, status, headers
+    return render_template('errors/503.html'), 503, headers
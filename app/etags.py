@@ -0,0 +1,43 @@
+"""
+etags.py
+
+Conditional GET support. Views derive a weak ETag from cheap version
+numbers, before running their expensive queries or rendering, and call
+conditional(); a client that already holds that ETag gets an empty 304
+straight away, and everyone else gets the full response tagged with it.
+"""
+
+import hashlib
+from flask import request, g, current_app, abort
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def conditional(etag):
+    """Answer with 304 if the client holds ``etag``; otherwise tag the
+    response that follows with it."""
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        abort(response)
+    g.etag = etag
+
+
+def _tag_response(response):
+    etag = g.pop('etag', None)
+    if etag is not None and response.status_code == 200:
+        # Weak, since nginx drops strong validators when it compresses;
+        # private and no-cache so only the browser keeps a copy, and
+        # always revalidates it
+        response.set_etag(etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+def init_app(app):
+    app.after_request(_tag_response)
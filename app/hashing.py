@@ -0,0 +1,111 @@
+"""
+hashing.py
+
+Password hashing runs on a small dedicated thread pool. Only
+PASSWORD_HASH_WORKERS hashes run at once per process, and once
+PASSWORD_HASH_QUEUE of them are waiting or running, further requests
+fail straight away with 503 instead of tying up every web worker on
+the deliberately slow key derivation. Responses to requests that
+hashed carry the wait and hash times in an X-Password-Hash header.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from flask import g, has_request_context
+from werkzeug import security
+from werkzeug.exceptions import ServiceUnavailable
+from .background import PerProcess
+
+
+class PasswordHashBusy(ServiceUnavailable):
+    description = 'Too many sign-ins in progress, please try again shortly.'
+
+
+class HashingPool(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.outstanding = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_time = 0.0
+        self.hash_time = 0.0
+        self._lock = threading.Lock()
+        self._executor = PerProcess(lambda: ThreadPoolExecutor(
+            self.app.config['PASSWORD_HASH_WORKERS'],
+            thread_name_prefix='password-hash'))
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['password_hasher'] = self
+        app.after_request(self._report)
+
+    def run(self, fn, *args):
+        """Run ``fn(*args)`` on the pool and wait for its result, or
+        raise PasswordHashBusy when too much work is already queued."""
+        timing = {'queue': 0.0, 'hash': 0.0}
+        if has_request_context():
+            g.password_hash = timing
+        with self._lock:
+            if self.outstanding >= self.app.config['PASSWORD_HASH_QUEUE']:
+                self.rejected += 1
+                raise PasswordHashBusy(retry_after=1)
+            self.outstanding += 1
+        queued = monotonic()
+
+        def job():
+            started = monotonic()
+            try:
+                return fn(*args)
+            finally:
+                timing['queue'] = started - queued
+                timing['hash'] = monotonic() - started
+                with self._lock:
+                    self.queue_time += timing['queue']
+                    self.hash_time += timing['hash']
+                    self.completed += 1
+
+        try:
+            return self._executor.get().submit(job).result()
+        finally:
+            with self._lock:
+                self.outstanding -= 1
+
+    def stats(self):
+        with self._lock:
+            done = self.completed or 1
+            return {
+                'outstanding': self.outstanding,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                # Average seconds spent waiting for and computing a hash
+                'queue_time': self.queue_time / done,
+                'hash_time': self.hash_time / done
+            }
+
+    def _report(self, response):
+        # Requests that hashed a password, or were turned away, report
+        # their own wait and hash times next to the process averages
+        timing = g.pop('password_hash', None)
+        if timing is not None:
+            response.headers['X-Password-Hash'] = (
+                'queue-time={queue:.3f}; hash-time={hash:.3f}; '
+                'avg-queue-time={queue_time:.3f}; '
+                'avg-hash-time={hash_time:.3f}; '
+                'outstanding={outstanding}; rejected={rejected}'
+            ).format(**timing, **self.stats())
+        return response
+
+
+password_hasher = HashingPool()
+
+
+def generate_password_hash(password):
+    return password_hasher.run(security.generate_password_hash, password)
+
+
+def check_password_hash(pwhash, password):
+    return password_hasher.run(security.check_password_hash, pwhash,
+                               password)
@@ -0,0 +1,46 @@
+"""
+language.py
+
+Language detection for posts. The langdetect profiles are loaded once
+per process by warm_up(), rather than on the first post a worker sees,
+and the detector is seeded so the same text always gets the same
+language.
+"""
+
+import threading
+from langdetect import DetectorFactory, LangDetectException
+from langdetect.detector_factory import PROFILES_DIRECTORY
+
+_factory = None
+_lock = threading.Lock()
+
+
+def warm_up():
+    global _factory
+    if _factory is not None:
+        return
+    with _lock:
+        if _factory is None:
+            factory = DetectorFactory()
+            factory.load_profile(PROFILES_DIRECTORY)
+            factory.set_seed(0)
+            _factory = factory
+
+
+def detect_language(text):
+    """Return the language code of ``text``, or '' when unknown."""
+    warm_up()
+    try:
+        detector = _factory.create()
+        detector.append(text)
+        language = detector.detect()
+    except LangDetectException:
+        return ''
+    # Post.language holds at most five characters, e.g. 'zh-cn'
+    return '' if language == 'unknown' else language[:5]
+
+
+def detect_languages(posts):
+    """Map (id, body) pairs to (id, language) pairs; used by the process
+    pool of the backfill command."""
+    return [(id, detect_language(body)) for id, body in posts]
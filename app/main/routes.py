@@ -1,16 +1,23 @@
 from flask import (
     Blueprint, render_template,
-    flash, redirect, url_for, request, current_app, g
+    flash, redirect, url_for, request, current_app, g, make_response,
+    Response, stream_with_context, abort, send_file, session
 )
 from flask_login import current_user, login_required
 from flask_babel import get_locale, _
 import sqlalchemy as sa
+import os
+import json
+from time import monotonic, time
 from app.models import db, User, Post, Message, Notification
 from .forms import (EditProfileForm, EmptyForm, PostForm,
                     SearchForm, MessageForm)
-from datetime import datetime, timezone
-from langdetect import detect, LangDetectException
-from app.translate import translate
+from app.translate import translate, translate_many
+from app.tasks import export_path
+from app.pagination import keyset_paginate
+from app.etags import make_etag, conditional
+from app.presence import last_seen
+from app.search import search_cache_stats
 
 # Define blueprint
 routes_bp = Blueprint('routes', __name__)
@@ -24,29 +31,26 @@ routes_bp = Blueprint('routes', __name__)
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
-        post = Post(body=form.post.data, author=current_user,
-                    language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
+        db.session.flush()
+        # The language and the fan-out are left to workers, off the
+        # request path
+        Post.defer_processing([post.id])
         db.session.commit()
         flash('Your post is now live!')
         return redirect(url_for('routes.index'))
 
     # Pagination
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(),
-                        page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
+    posts = current_user.home_timeline(current_app.config['POSTS_PER_PAGE'],
+                                       before=request.args.get('before'),
+                                       after=request.args.get('after'))
 
     # Add navigation arrows
-    next_url = url_for('routes.index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('routes.index', page=posts.prev_num) \
-        if posts.has_prev else None
+    next_url = url_for('routes.index', **posts.next_args) \
+        if posts.next_args else None
+    prev_url = url_for('routes.index', **posts.prev_args) \
+        if posts.prev_args else None
 
     return render_template('index.html', title='Home Page',
                            form=form, posts=posts.items,
@@ -58,31 +62,42 @@ def index():
 @login_required
 def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get('page', 1, type=int)
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
+    # The page only changes with these; forms on it carry CSRF tokens,
+    # which expire, so a cached copy is only reused for ten minutes
+    if '_flashes' not in session:
+        conditional(make_etag(
+            'user', user.id, user.version, user.last_seen,
+            current_user.id, current_user.version,
+            current_user.num_unread_messages, g.locale,
+            request.args.get('before'), request.args.get('after'),
+            int(time() // 600)))
+    posts = keyset_paginate(user.posts.select(),
+                            [Post.timestamp, Post.id],
+                            current_app.config['POSTS_PER_PAGE'],
+                            before=request.args.get('before'),
+                            after=request.args.get('after'),
+                            loader=Post.list_rows)
     # Add navigation arrows
     next_url = url_for('routes.user', username=user.username,
-                       page=posts.next_num) if posts.has_next else None
+                       **posts.next_args) if posts.next_args else None
     prev_url = url_for('routes.user', username=user.username,
-                       page=posts.prev_num) if posts.has_prev else None
+                       **posts.prev_args) if posts.prev_args else None
     form = EmptyForm()
 
     # Add form for follow and unfollow
     form = EmptyForm()
+    export_ready = user == current_user and \
+        os.path.exists(export_path(user.id))
     return render_template('user.html', user=user, posts=posts.items,
                            next_url=next_url, prev_url=prev_url,
-                           form=form)
+                           form=form, export_ready=export_ready)
 
 
 # Record time of last visit
 @routes_bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        last_seen.touch(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
@@ -159,16 +174,16 @@ def unfollow(username):
 @routes_bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
+    posts = keyset_paginate(sa.select(Post), [Post.timestamp, Post.id],
+                            current_app.config['POSTS_PER_PAGE'],
+                            before=request.args.get('before'),
+                            after=request.args.get('after'),
+                            loader=Post.list_rows)
     # Add navigation arrows
-    next_url = url_for('routes.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('routes.explore', page=posts.prev_num) \
-        if posts.has_prev else None
+    next_url = url_for('routes.explore', **posts.next_args) \
+        if posts.next_args else None
+    prev_url = url_for('routes.explore', **posts.prev_args) \
+        if posts.prev_args else None
 
     return render_template('index.html', title='Explore', posts=posts.items,
                            next_url=next_url, prev_url=prev_url)
@@ -186,6 +201,30 @@ def translate_text():
             }
 
 
+# Translate a page of posts at once
+@routes_bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_posts():
+    data = request.get_json(silent=True)
+    post_ids = data.get('post_ids') if isinstance(data, dict) else None
+    if not isinstance(post_ids, list):
+        abort(400)
+    try:
+        ids = [int(id) for id in post_ids]
+    except (TypeError, ValueError):
+        abort(400)
+    if len(ids) > current_app.config['TRANSLATE_BATCH_LIMIT']:
+        abort(400)
+    posts = db.session.execute(
+        sa.select(Post.id, Post.body, Post.language).where(
+            Post.id.in_(ids), Post.language != '')).all()
+    translations = translate_many(
+        [(post.body, post.language) for post in posts],
+        data.get('dest_language') or g.locale)
+    return {'translations': {str(post.id): translation for post, translation
+                             in zip(posts, translations)}}
+
+
 # Search
 @routes_bp.route('/search')
 @login_required
@@ -201,8 +240,14 @@ def search():
     prev_url = url_for('routes.search', q=g.search_form.q.data,
                        page=page - 1) if \
         page > 1 else None
-    return render_template('search.html', title=_('Search'), posts=posts,
-                           next_url=next_url, prev_url=prev_url)
+    response = make_response(render_template(
+        'search.html', title=_('Search'), posts=posts,
+        next_url=next_url, prev_url=prev_url))
+    stats = search_cache_stats()
+    response.headers['X-Search-Cache'] = \
+        'hits={hits}; misses={misses}; hit-rate={hit_rate:.2f}'.format(
+            **stats)
+    return response
 
 
 # User popup view function
@@ -224,6 +269,7 @@ def send_message(recipient):
         msg = Message(author=current_user, recipient=user,
                       body=form.message.data)
         db.session.add(msg)
+        User._adjust_counters(user.id, num_unread_messages=1)
         user.add_notification('unread_message_count',
                               user.unread_message_count())
         db.session.commit()
@@ -237,19 +283,19 @@ def send_message(recipient):
 @routes_bp.route('/messages')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.now(timezone.utc)
+    current_user.mark_messages_read()
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    query = current_user.messages_received.select().order_by(
-        Message.timestamp.desc())
-    messages = db.paginate(query, page=page,
-                           per_page=current_app.config['POSTS_PER_PAGE'],
-                           error_out=False)
-    next_url = url_for('routes.messages', page=messages.next_num) \
-        if messages.has_next else None
-    prev_url = url_for('routes.messages', page=messages.prev_num) \
-        if messages.has_prev else None
+    messages = keyset_paginate(current_user.messages_received.select(),
+                               [Message.timestamp, Message.id],
+                               current_app.config['POSTS_PER_PAGE'],
+                               before=request.args.get('before'),
+                               after=request.args.get('after'),
+                               loader=Message.list_rows)
+    next_url = url_for('routes.messages', **messages.next_args) \
+        if messages.next_args else None
+    prev_url = url_for('routes.messages', **messages.prev_args) \
+        if messages.prev_args else None
     return render_template('messages.html', messages=messages.items,
                            next_url=next_url, prev_url=prev_url)
 
@@ -259,6 +305,10 @@ def messages():
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
+    latest = db.session.scalar(
+        sa.select(sa.func.max(Notification.timestamp)).where(
+            Notification.user_id == current_user.id))
+    conditional(make_etag('notifications', current_user.id, since, latest))
     query = current_user.notifications.select().where(
         Notification.timestamp > since).order_by(
         Notification.timestamp.asc())
@@ -270,6 +320,71 @@ def notifications():
             } for n in notifications]
 
 
+# Server-sent event stream of notifications
+@routes_bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    since = request.headers.get('Last-Event-ID', type=float) or \
+        request.args.get('since', 0.0, type=float)
+    user_id = current_user.id
+    app = current_app._get_current_object()
+    # 204 tells the browser not to reconnect, so it polls instead
+    if not app.notification_streams.acquire():
+        return Response(status=204)
+    broker = app.notification_broker
+    # Subscribe before reading the backlog so nothing falls in between
+    subscription = broker.subscribe(Notification.channel(user_id))
+
+    def pending(since):
+        query = sa.select(Notification).where(
+            Notification.user_id == user_id,
+            Notification.timestamp > since).order_by(
+            Notification.timestamp.asc())
+        events = [n.to_event() for n in db.session.scalars(query)]
+        # Do not hold a pooled connection for the life of the stream
+        db.session.close()
+        return events
+
+    def format_event(event):
+        return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+            event['timestamp'], event['name'], json.dumps(event['data']))
+
+    def events(since):
+        yield 'retry: 10000\n\n'
+        for event in pending(since):
+            since = event['timestamp']
+            yield format_event(event)
+        deadline = monotonic() + app.config['NOTIFICATIONS_STREAM_TIMEOUT']
+        while monotonic() < deadline:
+            event = subscription.get(
+                timeout=app.config['NOTIFICATIONS_HEARTBEAT'])
+            if event is not None:
+                if event['timestamp'] > since:
+                    since = event['timestamp']
+                    yield format_event(event)
+                continue
+            # An in-process broker misses events published by Celery
+            # workers, so look them up in the database between waits
+            if not broker.shared:
+                for event in pending(since):
+                    since = event['timestamp']
+                    yield format_event(event)
+            yield ': keep-alive\n\n'
+
+    def close():
+        subscription.close()
+        app.notification_streams.release()
+
+    response = Response(stream_with_context(events(since)),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+    # Runs when the server closes the response, even if the client left
+    # before the stream started
+    response.call_on_close(close)
+    return response
+
+
 # Export post route and view function
 @routes_bp.route('/export_posts')
 @login_required
@@ -277,6 +392,19 @@ def export_posts():
     if current_user.get_task_in_progress('export_posts'):
         flash(_('An export task is currently in progress'))
     else:
-        current_user.launch_task('export_posts', _('Exporting posts...'))
+        current_user.launch_task(
+            'export_posts', _('Exporting posts...'),
+            download_url=url_for('routes.download_export', _external=True))
         db.session.commit()
     return redirect(url_for('routes.user', username=current_user.username))
+
+
+# Download the most recent export of the user's posts
+@routes_bp.route('/export_posts/download')
+@login_required
+def download_export():
+    path = export_path(current_user.id)
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype='application/gzip',
+                     as_attachment=True, download_name='posts.ndjson.gz')
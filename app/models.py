@@ -8,18 +8,22 @@ from time import time
 from typing import Optional
 import sqlalchemy as sa
 import sqlalchemy.orm as so
-from flask import current_app, url_for
+from sqlalchemy.dialects import postgresql
+from flask import current_app, url_for, request
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from .hashing import generate_password_hash, check_password_hash
 from flask_login import UserMixin, LoginManager
 from hashlib import md5
 import jwt
-from .search import add_to_index, remove_from_index, query_index
+from .search import (query_index, bulk_update_index, create_index,
+                     swap_alias)
+from .pagination import (keyset_paginate, keyset_merge, KeysetPage,
+                         encode_cursor, decode_cursor)
+from .etags import make_etag, conditional
 import json
 from celery import current_app as celery_app
-from celery.result import AsyncResult
-from celery.exceptions import CeleryError
 import secrets
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Initialize SQLAlchemy instance
@@ -40,6 +44,21 @@ followers = sa.Table(
 )
 
 
+# Materialized home timelines; one row per (reader, post) pushed on write,
+# with the post's timestamp so pages are read straight off the index
+timeline = sa.Table(
+    'timeline',
+    db.metadata,
+    sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'),
+              primary_key=True),
+    sa.Column('post_id', sa.Integer, sa.ForeignKey('post.id'),
+              primary_key=True),
+    sa.Column('timestamp', sa.DateTime, nullable=False),
+    sa.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp',
+             'post_id')
+)
+
+
 class SearchableMixin(object):
     @classmethod
     def search(cls, expression, page, per_page):
@@ -47,73 +66,265 @@ class SearchableMixin(object):
                                  expression, page, per_page)
         if total == 0:
             return [], 0
-        when = []
-        for index in range(len(ids)):
-            when.append((ids[index], index))
-        query = sa.select(cls).where(cls.id.in_(ids)).order_by(
-                db.case(*when, value=cls.id))
-        return db.session.scalars(query), total
+        # Fetch the rows once and restore the ranking in Python
+        rows = {row.id: row for row in
+                cls.list_rows(sa.select(cls).where(cls.id.in_(ids)))}
+        return [rows[id] for id in ids if id in rows], total
 
+    # Execute a select(cls) for rendering as a list; models can override
+    # this with a cheaper projection
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-                'add': list(session.new),
-                'update': list(session.dirty),
-                'delete': list(session.deleted)
-        }
+    def list_rows(cls, query):
+        return db.session.scalars(query).all()
 
+    # Rebuild the index into a fresh versioned copy, streaming id-range
+    # chunks through a thread pool, then swap the alias over to it. The
+    # rebuild is registered first, so that changes made meanwhile are
+    # written to the new copy as well as to the live index
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+    def reindex(cls, chunk_size=1000, workers=4, progress=None):
+        app = current_app._get_current_object()
+        alias = cls.__tablename__
+        index = f'{alias}-{int(time())}'
+        columns = [getattr(cls, field) for field in cls.__searchable__]
+
+        def index_chunk(bounds):
+            with app.app_context():
+                # The shared row locks make concurrent edits wait until
+                # this chunk is written, so theirs lands on top of it
+                rows = db.session.execute(
+                    sa.select(cls.id, *columns)
+                    .where(cls.id >= bounds[0], cls.id < bounds[1])
+                    .with_for_update(read=True)
+                ).all()
+                bulk_update_index(index, {row[0]: dict(
+                    zip(cls.__searchable__, row[1:])) for row in rows}, [])
+                db.session.commit()
+                db.session.remove()
+                return len(rows)
+
+        create_index(index)
+        db.session.merge(SearchReindex(alias=alias, target=index))
+        db.session.commit()
+        try:
+            if db.session.get_bind().dialect.name == 'postgresql':
+                # Wait for transactions that wrote rows before the rebuild
+                # was registered, so the chunks below can see their rows
+                db.session.execute(sa.text(
+                    f'LOCK TABLE {cls.__table__.name} IN SHARE MODE'))
+                db.session.commit()
+            low, high = db.session.execute(
+                sa.select(sa.func.min(cls.id), sa.func.max(cls.id))).one()
+            total = 0
+            if high is not None:
+                # Stop at high so rows added meanwhile are left to the
+                # catch-up
+                chunks = [(start, min(start + chunk_size, high + 1))
+                          for start in range(low, high + 1, chunk_size)]
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    for count in pool.map(index_chunk, chunks):
+                        total += count
+                        if progress:
+                            progress(total)
+                # Catch rows created while the chunks were being indexed
+                # that did not come through after_flush, e.g. bulk loads
+                while True:
+                    latest = db.session.scalar(
+                        sa.select(sa.func.max(cls.id)))
+                    if latest is None or latest <= high:
+                        break
+                    total += index_chunk((high + 1, latest + 1))
+                    high = latest
+            # Writers hold a shared lock on the registration until they
+            # commit, so none is left writing to the copy once it is gone
+            db.session.execute(sa.delete(SearchReindex).where(
+                SearchReindex.alias == alias))
+            swap_alias(alias, index)
+            db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            db.session.execute(sa.delete(SearchReindex).where(
+                SearchReindex.alias == alias, SearchReindex.target == index))
+            db.session.commit()
+            raise
+        current_app.search_cache.clear()
+        return total
+
+    # Apply index changes to the live index and to any copy of it being
+    # rebuilt by reindex()
+    @staticmethod
+    def update_index(index, documents, removed_ids):
+        for name in [index] + SearchReindex.targets(index):
+            bulk_update_index(name, documents, removed_ids)
 
+    # Bring the index in line with the current rows for the given ids
     @classmethod
-    def reindex(cls):
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
+    def sync_index(cls, ids):
+        found = db.session.scalars(sa.select(cls).where(cls.id.in_(ids)))
+        documents = {obj.id: {field: getattr(obj, field)
+                              for field in cls.__searchable__}
+                     for obj in found}
+        removed = [id for id in ids if id not in documents]
+        cls.update_index(cls.__tablename__, documents, removed)
+
+    # Index rows inserted in bulk, which after_flush never sees, the same
+    # way; documents maps ids to their searchable fields
+    @classmethod
+    def index_inserted(cls, documents):
+        if not current_app.search or not documents:
+            return
+        if current_app.search.transactional:
+            cls.update_index(cls.__tablename__, documents, [])
+            return
+        Outbox.record('search', [{'index': cls.__tablename__, 'id': id}
+                                 for id in documents])
+
+    @staticmethod
+    def searchable_models():
+        return {cls.__tablename__: cls
+                for cls in SearchableMixin.__subclasses__()}
+
+    # Record changes to searchable rows in the outbox, inside the same
+    # transaction, so a worker can index them after the commit
+    @staticmethod
+    def after_flush(session, flush_context):
+        if not current_app.search:
+            return
+        changed = [obj for obj in session.new
+                   if isinstance(obj, SearchableMixin)]
+        changed += [obj for obj in session.dirty
+                    if isinstance(obj, SearchableMixin) and any(
+                        so.attributes.get_history(obj, field).has_changes()
+                        for field in obj.__searchable__)]
+        deleted = [obj for obj in session.deleted
+                   if isinstance(obj, SearchableMixin)]
+        if not changed and not deleted:
+            return
+        # Backends living in the database are updated in this transaction
+        if current_app.search.transactional:
+            for index in {obj.__tablename__ for obj in changed + deleted}:
+                SearchableMixin.update_index(
+                    index,
+                    {obj.id: {field: getattr(obj, field)
+                              for field in obj.__searchable__}
+                     for obj in changed if obj.__tablename__ == index},
+                    [obj.id for obj in deleted
+                     if obj.__tablename__ == index])
+            return
+        Outbox.record('search', [{'index': obj.__tablename__, 'id': obj.id}
+                                 for obj in changed + deleted])
+
+    @staticmethod
+    def after_commit(session):
+        if session.info.pop('outbox_pending', False):
+            Outbox.dispatch()
+
+    @staticmethod
+    def after_soft_rollback(session, previous_transaction):
+        session.info.pop('outbox_pending', None)
 
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_soft_rollback',
+                SearchableMixin.after_soft_rollback)
 
 
 # Paginated representation mixin class
 class PaginatedAPIMixin(object):
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
-        resources = db.paginate(query, page=page, per_page=per_page,
-                                error_out=False)
+    @classmethod
+    def to_collection_dict(cls, query, key, per_page, endpoint, before=None,
+                           after=None, fieldset=None, **kwargs):
+        def loader(window):
+            # The page is unchanged while neither its members nor any of
+            # their versions are, so the ETag is taken from the window's
+            # keys alone and a 304 never loads the full rows
+            versions = db.session.execute(window.with_only_columns(
+                cls.id, cls.version, cls.last_seen)).all()
+            conditional(make_etag(request.full_path,
+                                  [tuple(row) for row in versions]))
+            if not versions:
+                return []
+            # Only the columns behind the requested fields are loaded
+            rows = query.where(cls.id.in_([row.id for row in versions]))
+            if fieldset is not None:
+                rows = rows.options(cls.api_load_options(fieldset))
+            found = {item.id: item for item in db.session.scalars(rows)}
+            return [found[row.id] for row in versions if row.id in found]
+
+        resources = keyset_paginate(query, [key], per_page, before=before,
+                                    after=after, descending=False,
+                                    loader=loader)
+        # Work shared by every item is done once for the page
+        links = cls.link_templates()
         data = {
-                'items': [item.to_dict() for item in resources.items],
+                'items': [item.to_dict(links=links, fields=fieldset)
+                          for item in resources.items],
                 '_meta': {
-                    'page': page,
                     'per_page': per_page,
-                    'total_pages': resources.pages,
-                    'total_items': resources.total
+                    'count': len(resources.items)
                 },
                 '_links': {
-                    'self': url_for(endpoint, page=page,
-                                    per_page=per_page, **kwargs),
+                    'self': url_for(endpoint, per_page=per_page,
+                                    before=before, after=after, **kwargs),
                     'next': url_for(
-                        endpoint, page=page + 1,
-                        per_page=per_page,
-                        **kwargs) if resources.has_next else None,
+                        endpoint, per_page=per_page,
+                        **resources.next_args,
+                        **kwargs) if resources.next_args else None,
                     'prev': url_for(
-                        endpoint, page=page - 1,
-                        per_page=per_page,
-                        **kwargs) if resources.has_prev else None,
+                        endpoint, per_page=per_page,
+                        **resources.prev_args,
+                        **kwargs) if resources.prev_args else None,
                     }
         }
         return data
 
+    @classmethod
+    def to_collection_stream(cls, query, key, per_page, endpoint,
+                             after=None, fieldset=None, chunk_size=500,
+                             **kwargs):
+        """Yield a page of the collection as NDJSON, one line per item.
+
+        Items are read from a server-side cursor and encoded as they
+        arrive, so memory does not grow with the page size. The last line
+        holds the _meta and _links of the dict representation; streamed
+        pages only link forwards.
+        """
+        if fieldset is not None:
+            query = query.options(cls.api_load_options(fieldset))
+        values = decode_cursor(after, [key]) if after else None
+        if values is not None:
+            query = query.where(key > values[0])
+        query = query.order_by(None).order_by(key.asc()).limit(per_page + 1)
+        links = cls.link_templates()
+        dumps = current_app.json.dumps
+        count, last, more = 0, None, False
+        result = db.session.scalars(
+            query.execution_options(yield_per=chunk_size))
+        try:
+            for partition in result.partitions():
+                if count + len(partition) > per_page:
+                    partition, more = partition[:per_page - count], True
+                if partition:
+                    count += len(partition)
+                    last = partition[-1]
+                    yield ''.join(
+                        dumps(item.to_dict(links=links, fields=fieldset)) +
+                        '\n' for item in partition)
+        finally:
+            result.close()
+        yield dumps({
+            '_meta': {'per_page': per_page, 'count': count},
+            '_links': {
+                'self': url_for(endpoint, per_page=per_page, after=after,
+                                **kwargs),
+                'next': url_for(
+                    endpoint, per_page=per_page,
+                    after=encode_cursor([getattr(last, key.key)]),
+                    **kwargs) if more else None
+            }
+        }) + '\n'
+
 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
@@ -171,6 +382,20 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         sa.String(32), index=True, unique=True)
     token_expiration: so.Mapped[Optional[datetime]]
 
+    # Denormalized counters, maintained on write
+    num_followers: so.Mapped[int] = so.mapped_column(
+        index=True, default=0, server_default='0')
+    num_following: so.Mapped[int] = so.mapped_column(
+        default=0, server_default='0')
+    num_posts: so.Mapped[int] = so.mapped_column(
+        default=0, server_default='0')
+    num_unread_messages: so.Mapped[int] = so.mapped_column(
+        default=0, server_default='0')
+    # Bumped whenever the profile, follows, posts or tasks change, to
+    # derive ETags from
+    version: so.Mapped[int] = so.mapped_column(default=0,
+                                               server_default='0')
+
     def __repr__(self):
         return f'<User {self.username}>'
 
@@ -189,47 +414,177 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            User._adjust_counters(self.id, num_following=1, version=1)
+            User._adjust_counters(user.id, num_followers=1, version=1)
+            # Backfill recent posts unless they are merged at read time
+            if not user.is_high_follower():
+                self._backfill_timeline(user)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            User._adjust_counters(self.id, num_following=-1, version=1)
+            User._adjust_counters(user.id, num_followers=-1, version=1)
+            db.session.execute(timeline.delete().where(
+                timeline.c.user_id == self.id,
+                timeline.c.post_id.in_(
+                    sa.select(Post.id).where(Post.user_id == user.id))
+            ))
+            # Back under the fan-out limit, the author's posts are no
+            # longer merged on read, so push them to the followers left
+            if db.session.scalar(sa.select(User.num_followers).where(
+                    User.id == user.id)) == \
+                    current_app.config['TIMELINE_FANOUT_LIMIT']:
+                Outbox.record('backfill', [{'ids': [user.id]}])
+
+    def _backfill_timeline(self, user):
+        recent = (
+                sa.select(sa.literal(self.id), Post.id, Post.timestamp)
+                .where(
+                    Post.user_id == user.id,
+                    ~sa.exists().where(timeline.c.user_id == self.id,
+                                       timeline.c.post_id == Post.id)
+                )
+                .order_by(Post.timestamp.desc())
+                .limit(current_app.config['TIMELINE_BACKFILL'])
+        )
+        db.session.execute(
+            timeline.insert().from_select(
+                ['user_id', 'post_id', 'timestamp'], recent)
+        )
+
+    # _backfill_timeline() for every follower of authors that dropped
+    # back under the fan-out limit
+    @staticmethod
+    def backfill_followers(author_ids):
+        for author in db.session.scalars(sa.select(User).where(
+                User.id.in_(author_ids))):
+            if author.is_high_follower():
+                continue
+            recent = (
+                    sa.select(Post.id, Post.timestamp)
+                    .where(Post.user_id == author.id)
+                    .order_by(Post.timestamp.desc())
+                    .limit(current_app.config['TIMELINE_BACKFILL'])
+                    .subquery()
+            )
+            readers = (
+                    sa.select(followers.c.follower_id, recent.c.id,
+                              recent.c.timestamp)
+                    .join_from(followers, recent, sa.true())
+                    .where(
+                        followers.c.followed_id == author.id,
+                        ~sa.exists().where(
+                            timeline.c.user_id == followers.c.follower_id,
+                            timeline.c.post_id == recent.c.id)
+                    )
+            )
+            db.session.execute(
+                timeline.insert().from_select(
+                    ['user_id', 'post_id', 'timestamp'], readers)
+            )
+
+    # Authors above the fan-out limit are merged into timelines on read
+    def is_high_follower(self):
+        return self.followers_count() > \
+            current_app.config['TIMELINE_FANOUT_LIMIT']
+
+    @staticmethod
+    def high_follower_ids():
+        return sa.select(User.id).where(
+            User.num_followers > current_app.config['TIMELINE_FANOUT_LIMIT'])
 
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
 
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery()
-        )
-        return db.session.scalar(query)
+        return self.num_followers or 0
 
     def following_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery()
+        return self.num_following or 0
+
+    # Counters are bumped in SQL so concurrent writers cannot lose updates
+    @staticmethod
+    def _adjust_counters(user_id, **deltas):
+        db.session.execute(
+            sa.update(User).where(User.id == user_id).values(
+                {name: getattr(User, name) + delta
+                 for name, delta in deltas.items()})
         )
-        return db.session.scalar(query)
 
-    # We get the posts from followed users
-    def following_posts(self):
-        # Create alias for users
-        Author = so.aliased(User)
-        Follower = so.aliased(User)
-        # We define an SQL query that gets the data we want
-        # we show both own and followed posts
-        return (
-                sa.select(Post)
-                .join(Post.author.of_type(Author))
-                .join(Author.followers.of_type(Follower), isouter=True)
-                .where(
-                    sa.or_(
-                        Follower.id == self.id,
-                        Author.id == self.id,
-                    )
-                )
-                .group_by(Post)
-                .order_by(Post.timestamp.desc())
+    # Recompute every counter from the source tables, fixing any drift
+    @staticmethod
+    def repair_counters():
+        actual = {
+            'num_followers': sa.select(sa.func.count()).where(
+                followers.c.followed_id == User.id).scalar_subquery(),
+            'num_following': sa.select(sa.func.count()).where(
+                followers.c.follower_id == User.id).scalar_subquery(),
+            'num_posts': sa.select(sa.func.count()).where(
+                Post.user_id == User.id).scalar_subquery(),
+            'num_unread_messages': sa.select(sa.func.count()).where(
+                Message.recipient_id == User.id,
+                sa.or_(User.last_message_read_time.is_(None),
+                       Message.timestamp > User.last_message_read_time)
+            ).scalar_subquery(),
+        }
+        drifted = sa.or_(*[getattr(User, name) != value
+                           for name, value in actual.items()])
+        result = db.session.execute(
+            sa.update(User).where(drifted).values(actual)
+            .execution_options(synchronize_session=False)
         )
+        return result.rowcount
+
+    def home_timeline(self, per_page, before=None, after=None):
+        """Return a KeysetPage of the home timeline, newest first.
+
+        Pushed posts are read from the timeline index, and our own posts
+        and those of followed high-follower authors from the post index,
+        one bounded window per author; only the page's posts are loaded.
+        """
+        authors = [self.id] + db.session.scalars(
+            sa.select(followers.c.followed_id).where(
+                followers.c.follower_id == self.id,
+                followers.c.followed_id.in_(User.high_follower_ids()))
+        ).all()
+        sources = [(sa.select(timeline.c.timestamp, timeline.c.post_id)
+                    .where(timeline.c.user_id == self.id),
+                    [timeline.c.timestamp, timeline.c.post_id])]
+        sources += [(sa.select(Post.timestamp, Post.id)
+                     .where(Post.user_id == author),
+                     [Post.timestamp, Post.id]) for author in authors]
+        page = keyset_merge(sources, per_page, before=before, after=after)
+        ids = [id for _timestamp, id in page.items]
+        rows = {row.id: row for row in Post.list_rows(
+            sa.select(Post).where(Post.id.in_(ids)))} if ids else {}
+        return KeysetPage([rows[id] for id in ids if id in rows],
+                          [Post.timestamp, Post.id], page.descending,
+                          page.has_next, page.has_prev)
+
+    @staticmethod
+    def trim_timelines(length):
+        """Drop pushed posts beyond the newest ``length`` of each home
+        timeline, returning how many were removed."""
+        removed = 0
+        users = db.session.scalars(
+            sa.select(timeline.c.user_id).group_by(timeline.c.user_id)
+            .having(sa.func.count() > length)).all()
+        for user_id in users:
+            edge = db.session.execute(
+                sa.select(timeline.c.timestamp, timeline.c.post_id)
+                .where(timeline.c.user_id == user_id)
+                .order_by(timeline.c.timestamp.desc(),
+                          timeline.c.post_id.desc())
+                .offset(length).limit(1)).one()
+            removed += db.session.execute(timeline.delete().where(
+                timeline.c.user_id == user_id,
+                timeline.c.timestamp <= edge.timestamp,
+                sa.or_(timeline.c.timestamp < edge.timestamp,
+                       timeline.c.post_id <= edge.post_id))).rowcount
+            db.session.commit()
+        return removed
 
     # Password reset methods
     def get_reset_password_token(self, expires_in=600):
@@ -254,19 +609,30 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 
     # Get unread message count
     def unread_message_count(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        query = sa.select(Message).where(Message.recipient == self,
-                                         Message.timestamp > last_read_time)
-        return db.session.scalar(sa.select(sa.func.count()).select_from(
-                                 query.subquery()))
+        return self.num_unread_messages or 0
+
+    def mark_messages_read(self):
+        self.last_message_read_time = datetime.now(timezone.utc)
+        self.num_unread_messages = 0
 
     # Notification helper method
-    def add_notification(self, name, data):
-        db.session.execute(self.notifications.delete().where(
-                           Notification.name == name))
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+    def add_notification(self, name, data, min_interval=None):
+        """Store the latest ``name`` notification, returning whether it
+        was written.
+
+        Writes closer than ``min_interval`` seconds to the previous one,
+        NOTIFICATION_THROTTLE[name] by default, are dropped.
+        """
+        if min_interval is None:
+            min_interval = current_app.config['NOTIFICATION_THROTTLE'].get(
+                name, 0)
+        timestamp = Notification.upsert(self.id, name, data, min_interval)
+        if timestamp is None:
+            return False
+        # Pushed to the user's stream once the transaction commits
+        db.session.info.setdefault('notifications', []).append(
+            (self.id, {'name': name, 'data': data, 'timestamp': timestamp}))
+        return True
 
     # Task helper methods
     def launch_task(self, name, description, *args, **kwargs):
@@ -279,6 +645,8 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         task = Task(id=result.id, name=name,
                     description=description, user=self)
         db.session.add(task)
+        # Every page lists the tasks in progress
+        User._adjust_counters(self.id, version=1)
         return task
 
     def get_tasks_in_progress(self):
@@ -292,31 +660,77 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 
     # Generate a dictionary from the user model
     def post_count(self):
-        query = sa.select(sa.func.count()).select_from(
-                self.posts.select().subquery())
-        return db.session.scalar(query)
+        return self.num_posts or 0
 
-    def to_dict(self, include_email=False):
-        data = {
-                'id': self.id,
-                'username': self.username,
-                'last_seen': self.last_seen.replace(
-                    tzinfo=timezone.utc
-                ).isoformat() if self.last_seen else None,
-                'about_me': self.about_me,
-                'post_count': self.post_count(),
-                'follower_count': self.followers_count(),
-                'following_count': self.following_count(),
-                '_links': {
-                    'self': url_for('api.users.get_user', id=self.id),
-                    'followers': url_for('api.users.get_followers',
-                                         id=self.id),
-                    'following': url_for('api.users.get_following',
-                                         id=self.id),
-                    'avatar': self.avatar(128)
-                }
+    # Any id will do; it only marks where each user's id goes
+    _LINK_ID = 987654321
+
+    @staticmethod
+    def link_templates():
+        """Build the API links once, to be filled in per user."""
+        return {
+            name: url_for(endpoint, id=User._LINK_ID).replace(
+                str(User._LINK_ID), '{id}')
+            for name, endpoint in (('self', 'api.users.get_user'),
+                                   ('followers', 'api.users.get_followers'),
+                                   ('following', 'api.users.get_following'))
         }
-        if include_email:
+
+    # Fields the API can return, with the columns each one reads
+    API_FIELDS = {
+        'id': (),
+        'username': ('username',),
+        'last_seen': ('last_seen',),
+        'about_me': ('about_me',),
+        'post_count': ('num_posts',),
+        'follower_count': ('num_followers',),
+        'following_count': ('num_following',),
+        '_links': ('email',),
+    }
+    # Fields only returned when asked for with expand=
+    API_EXPANSIONS = {
+        'email': ('email',),
+    }
+
+    @staticmethod
+    def api_load_options(fields):
+        """Loader option reading only the columns ``fields`` need."""
+        columns = {'id', 'version', 'last_seen'}
+        for field in fields:
+            columns.update(User.API_FIELDS.get(field) or
+                           User.API_EXPANSIONS.get(field, ()))
+        return so.load_only(*[getattr(User, column) for column in columns])
+
+    def to_dict(self, include_email=False, links=None, fields=None):
+        # Collections pass the templates so URLs are not built per item
+        if fields is None:
+            fields = User.API_FIELDS
+        data = {}
+        if 'id' in fields:
+            data['id'] = self.id
+        if 'username' in fields:
+            data['username'] = self.username
+        if 'last_seen' in fields:
+            data['last_seen'] = self.last_seen.replace(
+                tzinfo=timezone.utc).isoformat() if self.last_seen else None
+        if 'about_me' in fields:
+            data['about_me'] = self.about_me
+        if 'post_count' in fields:
+            data['post_count'] = self.post_count()
+        if 'follower_count' in fields:
+            data['follower_count'] = self.followers_count()
+        if 'following_count' in fields:
+            data['following_count'] = self.following_count()
+        if '_links' in fields:
+            if links is None:
+                links = User.link_templates()
+            data['_links'] = {
+                'self': links['self'].format(id=self.id),
+                'followers': links['followers'].format(id=self.id),
+                'following': links['following'].format(id=self.id),
+                'avatar': self.avatar(128)
+            }
+        if include_email or 'email' in fields:
             data['email'] = self.email
         return data
 
@@ -335,24 +749,67 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             tzinfo=timezone.utc
         ) > now + timedelta(seconds=60):
             return self.token
+        self._forget_token()
         self.token = secrets.token_hex(16)
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
         return self.token
 
     def revoke_token(self):
+        self._forget_token()
         self.token_expiration = datetime.now(timezone.utc) - timedelta(
                 seconds=1)
 
+    def _forget_token(self):
+        # Dropped from the token cache once the change is committed
+        if self.token:
+            db.session.info.setdefault('revoked_tokens', []).append(
+                self.token)
+
     @staticmethod
     def check_token(token):
+        cached = current_app.token_cache.get(token)
+        if cached is not None:
+            user_id, expiry = cached
+            return TokenUser(user_id) if expiry > time() else None
         user = db.session.scalar(sa.select(User).where(User.token == token))
         if user is None or user.token_expiration.replace(
             tzinfo=timezone.utc
         ) < datetime.now(timezone.utc):
             return None
+        current_app.token_cache.set(
+            token, user.id,
+            user.token_expiration.replace(tzinfo=timezone.utc).timestamp())
         return user
 
+    @staticmethod
+    def after_commit(session):
+        revoked = session.info.pop('revoked_tokens', None)
+        if revoked:
+            current_app.token_cache.invalidate(*revoked)
+
+    @staticmethod
+    def after_soft_rollback(session, previous_transaction):
+        session.info.pop('revoked_tokens', None)
+
+
+db.event.listen(db.session, 'after_commit', User.after_commit)
+db.event.listen(db.session, 'after_soft_rollback', User.after_soft_rollback)
+
+
+class TokenUser(object):
+    """Stands in for a user authenticated from the token cache; the row
+    is only loaded if something other than the id is needed."""
+
+    def __init__(self, id):
+        self.id = id
+        self._user = None
+
+    def __getattr__(self, name):
+        if self._user is None:
+            self._user = db.session.get(User, self.id)
+        return getattr(self._user, name)
+
 
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
@@ -369,9 +826,175 @@ class Post(SearchableMixin, db.Model):
     author: so.Mapped[User] = so.relationship(back_populates='posts')
     language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
 
+    # An author's posts in order, for profiles and merged timelines
+    __table_args__ = (sa.Index('ix_post_user_id_timestamp', 'user_id',
+                               'timestamp'),)
+
     def __repr__(self):
         return f'<Post {self.body}'
 
+    # Run a select(Post) for _post.html, loading the authors in the same
+    # round trip and only the columns the template renders
+    @classmethod
+    def list_rows(cls, query):
+        if current_app.config['POST_LIST_ROWS']:
+            query = query.with_only_columns(
+                Post.id, Post.body, Post.timestamp, Post.language,
+                User.id, User.username, User.email
+            ).join_from(Post, User, Post.user_id == User.id)
+            return [PostRow(*row) for row in db.session.execute(query)]
+        query = query.options(
+            so.load_only(Post.id, Post.body, Post.timestamp, Post.language,
+                         Post.user_id),
+            so.joinedload(Post.author).load_only(User.username, User.email)
+        )
+        return db.session.scalars(query).all()
+
+    @staticmethod
+    def set_languages(languages):
+        """Store detected languages, a mapping of post ids to codes, with
+        one UPDATE ... CASE per 500 posts."""
+        table = Post.__table__
+        ids = list(languages)
+        for start in range(0, len(ids), 500):
+            batch = {id: languages[id] for id in ids[start:start + 500]}
+            db.session.execute(
+                table.update()
+                .where(table.c.id.in_(batch))
+                .values(language=sa.case(batch, value=table.c.id))
+            )
+            # The authors' pages now show a Translate link
+            db.session.execute(
+                sa.update(User.__table__)
+                .where(User.__table__.c.id.in_(
+                    sa.select(table.c.user_id).where(table.c.id.in_(batch))))
+                .values(version=User.__table__.c.version + 1)
+            )
+
+    @staticmethod
+    def insert_many(user_id, posts):
+        """Insert ``posts``, dicts with a body and a timestamp, for one
+        author with a single executemany, and return their ids in order.
+
+        The author's counters and the search index are updated here, as
+        the ORM events that do it for single posts do not see Core
+        inserts.
+        """
+        if not posts:
+            return []
+        table = Post.__table__
+        rows = [dict(post, user_id=user_id) for post in posts]
+        dialect = db.session.get_bind().dialect
+        if dialect.insert_executemany_returning_sort_by_parameter_order:
+            ids = db.session.execute(
+                table.insert().returning(table.c.id,
+                                         sort_by_parameter_order=True),
+                rows).scalars().all()
+        else:
+            # MySQL has no RETURNING, so the ids need a statement per row
+            ids = [db.session.execute(table.insert(), row)
+                   .inserted_primary_key[0] for row in rows]
+        User._adjust_counters(user_id, num_posts=len(ids), version=1)
+        Post.index_inserted({id: {field: row[field]
+                                  for field in Post.__searchable__}
+                             for id, row in zip(ids, rows)})
+        return ids
+
+    # Push the post into the home timelines of the author's followers
+    def fan_out(self):
+        if self.author.is_high_follower():
+            return
+        readers = (
+                sa.select(followers.c.follower_id, sa.literal(self.id),
+                          sa.literal(self.timestamp, sa.DateTime))
+                .where(
+                    followers.c.followed_id == self.user_id,
+                    ~sa.exists().where(
+                        timeline.c.user_id == followers.c.follower_id,
+                        timeline.c.post_id == self.id)
+                )
+        )
+        db.session.execute(
+            timeline.insert().from_select(
+                ['user_id', 'post_id', 'timestamp'], readers)
+        )
+
+    # fan_out() for a batch of posts in one INSERT ... SELECT
+    @staticmethod
+    def fan_out_many(post_ids):
+        readers = (
+                sa.select(followers.c.follower_id, Post.id, Post.timestamp)
+                .join_from(Post, followers,
+                           followers.c.followed_id == Post.user_id)
+                .where(
+                    Post.id.in_(post_ids),
+                    Post.user_id.not_in(User.high_follower_ids()),
+                    ~sa.exists().where(
+                        timeline.c.user_id == followers.c.follower_id,
+                        timeline.c.post_id == Post.id)
+                )
+        )
+        db.session.execute(
+            timeline.insert().from_select(
+                ['user_id', 'post_id', 'timestamp'], readers)
+        )
+
+    # Have workers detect the languages of new posts and fan them out.
+    # This goes through the outbox, in the posts' own transaction, so the
+    # work is not lost if the broker is down or the process dies after
+    # the commit
+    @staticmethod
+    def defer_processing(post_ids):
+        for topic in ('language', 'fan_out'):
+            Outbox.record(topic, [{'ids': list(post_ids)}])
+
+
+# Keep the author's post counter in step with every inserted post
+@sa.event.listens_for(Post, 'after_insert')
+def _count_new_post(mapper, connection, post):
+    connection.execute(
+        sa.update(User.__table__)
+        .where(User.__table__.c.id == post.user_id)
+        .values(num_posts=User.__table__.c.num_posts + 1,
+                version=User.__table__.c.version + 1)
+    )
+
+
+# Profile edits change the user's version too
+@sa.event.listens_for(User, 'before_update')
+def _bump_user_version(mapper, connection, user):
+    state = sa.inspect(user)
+    if any(state.attrs[name].history.has_changes()
+           for name in ('username', 'email', 'about_me')):
+        user.version = User.version + 1
+
+
+# Lightweight read-only rows used when rendering lists of posts
+class AuthorRow(object):
+    __slots__ = ('id', 'username', 'email')
+
+    def __init__(self, id, username, email):
+        self.id = id
+        self.username = username
+        self.email = email
+
+    avatar = User.avatar
+
+
+class PostRow(object):
+    __slots__ = ('id', 'body', 'timestamp', 'language', 'author')
+
+    def __init__(self, id, body, timestamp, language, author_id, username,
+                 email):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.language = language
+        self.author = AuthorRow(author_id, username, email)
+
+    def __repr__(self):
+        return f'<PostRow {self.body}>'
+
 
 # Message model
 class Message(db.Model):
@@ -394,6 +1017,11 @@ class Message(db.Model):
     def __repr__(self):
         return '<Message {}>'.format(self.body)
 
+    @staticmethod
+    def list_rows(query):
+        return db.session.scalars(
+            query.options(so.joinedload(Message.author))).all()
+
 
 # Notification model
 class Notification(db.Model):
@@ -406,9 +1034,91 @@ class Notification(db.Model):
 
     user: so.Mapped[User] = so.relationship(back_populates='notifications')
 
+    # A user keeps only the latest notification of each name
+    __table_args__ = (sa.UniqueConstraint(
+        'user_id', 'name', name='uq_notification_user_id_name'),)
+
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    def to_event(self):
+        return {'name': self.name, 'data': self.get_data(),
+                'timestamp': self.timestamp}
+
+    @staticmethod
+    def channel(user_id):
+        return f'notifications:{user_id}'
+
+    @staticmethod
+    def upsert(user_id, name, data, min_interval=0):
+        """Overwrite the (user_id, name) row in place, or insert it.
+
+        Returns the timestamp written, or None when the existing row is
+        younger than ``min_interval`` seconds and was left alone.
+        """
+        now = time()
+        table = Notification.__table__
+        values = {'timestamp': now, 'payload_json': json.dumps(data)}
+        updated = db.session.execute(
+            table.update()
+            .where(table.c.user_id == user_id, table.c.name == name,
+                   table.c.timestamp <= now - min_interval)
+            .values(**values)
+        ).rowcount
+        if updated:
+            return now
+        # Either there is no row yet, or a fresh one that must survive;
+        # the unique key turns the second case into a no-op
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            insert = postgresql.insert(table).on_conflict_do_nothing()
+        else:
+            insert = table.insert().prefix_with(
+                'OR IGNORE', dialect='sqlite').prefix_with(
+                'IGNORE', dialect='mysql').prefix_with(
+                'IGNORE', dialect='mariadb')
+        inserted = db.session.execute(
+            insert.values(user_id=user_id, name=name, **values)).rowcount
+        return now if inserted else None
+
+    @staticmethod
+    def purge(max_age, batch_size=1000):
+        """Delete notifications older than ``max_age`` seconds in small
+        batches, returning how many were removed."""
+        cutoff = time() - max_age
+        removed = 0
+        while True:
+            ids = db.session.scalars(
+                sa.select(Notification.id)
+                .where(Notification.timestamp < cutoff)
+                .limit(batch_size)
+            ).all()
+            if not ids:
+                return removed
+            db.session.execute(sa.delete(Notification.__table__).where(
+                Notification.__table__.c.id.in_(ids)))
+            db.session.commit()
+            removed += len(ids)
+
+    @staticmethod
+    def after_commit(session):
+        for user_id, event in session.info.pop('notifications', []):
+            try:
+                current_app.notification_broker.publish(
+                    Notification.channel(user_id), event)
+            except Exception:
+                current_app.logger.warning('Could not publish %s',
+                                           event['name'], exc_info=True)
+
+    @staticmethod
+    def after_soft_rollback(session, previous_transaction):
+        session.info.pop('notifications', None)
+
+
+db.event.listen(db.session, 'after_commit', Notification.after_commit)
+db.event.listen(db.session, 'after_soft_rollback',
+                Notification.after_soft_rollback)
+
 
 # Task model
 class Task(db.Model):
@@ -417,19 +1127,127 @@ class Task(db.Model):
     description: so.Mapped[Optional[str]] = so.mapped_column(sa.String(128))
     user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
     complete: so.Mapped[bool] = so.mapped_column(default=False)
+    progress: so.Mapped[int] = so.mapped_column(default=0,
+                                                server_default='0')
 
     user: so.Mapped[User] = so.relationship(back_populates='tasks')
 
-    def get_celery_task(self):
-        try:
-            result = AsyncResult(self.id)
-        except CeleryError:
-            return None
-        return result
+    # Every page looks up the user's unfinished tasks
+    __table_args__ = (sa.Index('ix_task_user_id_complete',
+                               'user_id', 'complete'),)
 
     def get_progress(self):
-        result = self.get_celery_task()
-        return result.info['current'] if result is not None else 100
+        return self.progress
+
+    @staticmethod
+    def sweep():
+        """Delete finished tasks, returning how many were removed."""
+        removed = db.session.execute(
+            sa.delete(Task.__table__).where(Task.__table__.c.complete)
+        ).rowcount
+        db.session.commit()
+        return removed
+
+
+# Transactional outbox for side effects that must follow a commit
+class Outbox(db.Model):
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    topic: so.Mapped[str] = so.mapped_column(sa.String(64), index=True)
+    created: so.Mapped[float] = so.mapped_column(default=time)
+    payload_json: so.Mapped[str] = so.mapped_column(sa.Text)
+
+    def get_data(self):
+        return json.loads(str(self.payload_json))
+
+    # Topics whose ids are handed on, in one batch, to a task
+    tasks = {'fan_out': 'app.tasks.fan_out_posts',
+             'language': 'app.tasks.detect_post_languages',
+             'backfill': 'app.tasks.backfill_followers'}
+
+    # Record side effects to run once the current transaction commits;
+    # goes through the connection, as it also runs inside flushes
+    @staticmethod
+    def record(topic, payloads):
+        if not payloads:
+            return
+        db.session.connection().execute(Outbox.__table__.insert(), [
+            {'topic': topic, 'created': time(),
+             'payload_json': json.dumps(payload)} for payload in payloads
+        ])
+        db.session.info['outbox_pending'] = True
+
+    # Nudge a worker; anything missed is picked up by the periodic drain.
+    # No result is awaited, so a missing broker fails fast
+    @staticmethod
+    def dispatch():
+        try:
+            celery_app.send_task('app.tasks.drain_outbox', ignore_result=True)
+        except Exception:
+            current_app.logger.warning('Could not dispatch the outbox',
+                                       exc_info=True)
+
+    @staticmethod
+    def drain(batch_size=500):
+        drained = 0
+        while True:
+            entries = db.session.scalars(
+                sa.select(Outbox).order_by(Outbox.id).limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not entries:
+                return drained
+            changed = {}
+            batches = {}
+            for entry in entries:
+                data = entry.get_data()
+                if entry.topic == 'search':
+                    changed.setdefault(data['index'], set()).add(data['id'])
+                elif entry.topic in Outbox.tasks:
+                    batches.setdefault(entry.topic, []).extend(data['ids'])
+            models = SearchableMixin.searchable_models()
+            for index, ids in changed.items():
+                models[index].sync_index(list(ids))
+            # Queued before the entries are deleted, so they stay for the
+            # next drain if the broker is down; the tasks are idempotent
+            for topic, ids in batches.items():
+                celery_app.send_task(Outbox.tasks[topic], args=[ids],
+                                     ignore_result=True)
+            db.session.execute(sa.delete(Outbox).where(
+                Outbox.id.in_([entry.id for entry in entries])))
+            db.session.commit()
+            drained += len(entries)
+
+
+# Search indexes being rebuilt; while a row exists, writes to the alias
+# are copied to the target index so that none are lost at the swap
+class SearchReindex(db.Model):
+    __tablename__ = 'search_reindex'
+    alias: so.Mapped[str] = so.mapped_column(sa.String(64),
+                                             primary_key=True)
+    target: so.Mapped[str] = so.mapped_column(sa.String(128))
+    started: so.Mapped[float] = so.mapped_column(default=time)
+
+    @staticmethod
+    def targets(alias):
+        # Read through the connection, as this also runs inside flushes;
+        # the shared lock keeps the rebuild from finishing until the
+        # caller's transaction is done
+        return db.session.connection().execute(
+            sa.select(SearchReindex.target)
+            .where(SearchReindex.alias == alias)
+            .with_for_update(read=True)).scalars().all()
+
+
+# Translations already fetched from the translation service
+class Translation(db.Model):
+    text_hash: so.Mapped[str] = so.mapped_column(sa.String(64),
+                                                 primary_key=True)
+    source_language: so.Mapped[str] = so.mapped_column(sa.String(16),
+                                                       primary_key=True)
+    dest_language: so.Mapped[str] = so.mapped_column(sa.String(16),
+                                                     primary_key=True)
+    translation: so.Mapped[str] = so.mapped_column(sa.Text)
+    created: so.Mapped[float] = so.mapped_column(default=time)
 
 
 # We register a user loader function with Flask-Login
@@ -0,0 +1,148 @@
+"""
+pagination.py
+
+Keyset (cursor) pagination. Instead of an OFFSET plus a COUNT(*), a page
+is anchored to the sort key of the row at its edge, so a deep page costs
+the same as the first one. Cursors are opaque url-safe tokens.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+import sqlalchemy as sa
+from flask import current_app
+
+
+def encode_cursor(values):
+    values = [v.isoformat() if isinstance(v, datetime) else v
+              for v in values]
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(token, keys):
+    # Invalid or tampered cursors simply yield the first page
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(keys):
+            return None
+        return tuple(
+            datetime.fromisoformat(value)
+            if isinstance(key.type, sa.DateTime) else key.type.python_type(
+                value)
+            for key, value in zip(keys, values)
+        )
+    except (binascii.Error, ValueError, TypeError, UnicodeDecodeError,
+            NotImplementedError):
+        return None
+
+
+def _beyond(keys, values, descending):
+    # Expanded row-value comparison, (a, b) < (x, y), which every
+    # backend can resolve with an index range scan
+    key, value = keys[0], values[0]
+    edge = key < value if descending else key > value
+    if len(keys) == 1:
+        return edge
+    return sa.or_(edge, sa.and_(key == value,
+                                _beyond(keys[1:], values[1:], descending)))
+
+
+def _window(query, keys, per_page, before, after, descending):
+    # The query restricted to the per_page + 1 rows past the cursor, in
+    # the order they are read, and whether that order is reversed
+    values, backwards = None, False
+    if before:
+        values, backwards = decode_cursor(before, keys), not descending
+    elif after:
+        values, backwards = decode_cursor(after, keys), descending
+    if values is None:
+        backwards = False
+    else:
+        query = query.where(_beyond(keys, values, descending != backwards))
+        if len(keys) > 1:
+            # A bound on the leading key alone keeps the scan a range
+            query = query.where(keys[0] <= values[0]
+                                if descending != backwards
+                                else keys[0] >= values[0])
+    order = [k.desc() if descending != backwards else k.asc() for k in keys]
+    query = query.order_by(None).order_by(*order).limit(per_page + 1)
+    return query, values is not None, backwards
+
+
+def _page(items, keys, per_page, descending, anchored, backwards):
+    more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+        return KeysetPage(items, keys, descending, True, more)
+    return KeysetPage(items, keys, descending, more, anchored)
+
+
+class KeysetPage(object):
+    """One page of results plus the cursors that lead away from it."""
+
+    def __init__(self, items, keys, descending, has_next, has_prev):
+        self.items = items
+        self.keys = keys
+        self.descending = descending
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+    def _cursor(self, item):
+        return encode_cursor([getattr(item, key.key) for key in self.keys])
+
+    @property
+    def next_args(self):
+        if not self.has_next or not self.items:
+            return None
+        arg = 'before' if self.descending else 'after'
+        return {arg: self._cursor(self.items[-1])}
+
+    @property
+    def prev_args(self):
+        if not self.has_prev or not self.items:
+            return None
+        arg = 'after' if self.descending else 'before'
+        return {arg: self._cursor(self.items[0])}
+
+
+def keyset_paginate(query, keys, per_page, before=None, after=None,
+                    descending=True, loader=None):
+    """Return a KeysetPage of ``query`` ordered on the unique ``keys``.
+
+    ``before`` and ``after`` are cursors returned by a previous page;
+    ``loader`` turns the final query into a list of items.
+    """
+    session = current_app.extensions['sqlalchemy'].session
+    if loader is None:
+        def loader(q):
+            return session.scalars(q).all()
+
+    query, anchored, backwards = _window(query, keys, per_page, before,
+                                         after, descending)
+    return _page(loader(query), keys, per_page, descending, anchored,
+                 backwards)
+
+
+def keyset_merge(sources, per_page, before=None, after=None,
+                 descending=True):
+    """Return a KeysetPage of the union of several sources.
+
+    Each source is a (query, keys) pair selecting only its keys, all in
+    the same order. Every source is windowed on its own index and bounded
+    by the page size, within one UNION ALL, so a page never reads more
+    than len(sources) * (per_page + 1) rows. Items are key tuples.
+    """
+    session = current_app.extensions['sqlalchemy'].session
+    windows = []
+    for query, keys in sources:
+        query, anchored, backwards = _window(query, keys, per_page, before,
+                                             after, descending)
+        windows.append(sa.select(query.subquery()))
+    rows = {tuple(row) for row in session.execute(sa.union_all(*windows))}
+    items = sorted(rows, reverse=descending != backwards)
+    return _page(items, sources[0][1], per_page, descending, anchored,
+                 backwards)
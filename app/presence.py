@@ -0,0 +1,110 @@
+"""
+presence.py
+
+Write-behind buffer for User.last_seen. Requests only record the time
+a user was seen, in process memory or in a Redis hash when one is
+configured, and a background thread writes the whole batch back with a
+single UPDATE ... CASE every LAST_SEEN_FLUSH_INTERVAL seconds.
+"""
+
+import atexit
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+import sqlalchemy as sa
+from .models import db, User
+from .background import PerProcess
+
+REDIS_KEY = 'microblog:last_seen'
+
+
+class LastSeenBuffer(object):
+    def __init__(self, app=None):
+        self.app = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = PerProcess(self._start_flusher)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.app is None:
+            atexit.register(self._flush_at_exit)
+        self.app = app
+        app.extensions['last_seen'] = self
+
+    def touch(self, user):
+        """Record a visit unless the stored value is still fresh."""
+        now = datetime.now(timezone.utc)
+        window = timedelta(seconds=self.app.config['LAST_SEEN_STALENESS'])
+        with self._lock:
+            seen = self._pending.get(user.id) or user.last_seen
+        if seen is not None and now - seen.replace(tzinfo=timezone.utc) \
+                < window:
+            return
+        with self._lock:
+            self._pending[user.id] = now
+        if self.app.redis is not None:
+            self.app.redis.hset(REDIS_KEY, user.id, now.isoformat())
+        self._ensure_flusher()
+
+    def _take(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if self.app.redis is None:
+            return pending
+        # Drain the shared hash atomically; other workers get the rest
+        pipe = self.app.redis.pipeline()
+        pipe.hgetall(REDIS_KEY)
+        pipe.delete(REDIS_KEY)
+        shared, _ = pipe.execute()
+        return {int(user_id): datetime.fromisoformat(seen.decode())
+                for user_id, seen in shared.items()}
+
+    def flush(self):
+        """Write every buffered last_seen value, returning how many."""
+        pending = self._take()
+        if not pending:
+            return 0
+        table = User.__table__
+        ids = list(pending)
+        with db.engine.begin() as connection:
+            for start in range(0, len(ids), 500):
+                batch = {user_id: pending[user_id]
+                         for user_id in ids[start:start + 500]}
+                connection.execute(
+                    table.update()
+                    .where(table.c.id.in_(batch))
+                    .values(last_seen=sa.case(batch, value=table.c.id))
+                )
+        return len(pending)
+
+    def _ensure_flusher(self):
+        self._flusher.get()
+
+    def _start_flusher(self):
+        flusher = threading.Thread(target=self._run, daemon=True,
+                                   name='last-seen-flusher')
+        flusher.start()
+        return flusher
+
+    def _run(self):
+        while True:
+            time.sleep(self.app.config['LAST_SEEN_FLUSH_INTERVAL'])
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception('last_seen flush failed')
+
+    def _flush_at_exit(self):
+        if not self._pending:
+            return
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('last_seen flush failed')
+
+
+last_seen = LastSeenBuffer()
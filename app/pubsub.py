@@ -0,0 +1,113 @@
+"""
+pubsub.py
+
+Publish/subscribe brokers used to push notifications to the browser as
+they happen. Redis pub/sub reaches every web worker and the Celery
+workers; the in-process broker is a stand-in for development that only
+reaches subscribers in the same process.
+"""
+
+import json
+import queue
+import threading
+
+
+class LocalSubscription(object):
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=100)
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker._unsubscribe(self)
+
+
+class LocalBroker(object):
+    # Whether messages published in other processes reach subscribers
+    shared = False
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                # A stalled client loses events and catches up on reconnect
+                pass
+
+    def subscribe(self, channel):
+        subscription = LocalSubscription(self, channel)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscribers.pop(subscription.channel, None)
+
+
+class RedisSubscription(object):
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def get(self, timeout):
+        message = self.pubsub.get_message(timeout=timeout)
+        return json.loads(message['data']) if message else None
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisBroker(object):
+    shared = True
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def publish(self, channel, message):
+        self.redis.publish(channel, json.dumps(message))
+
+    def subscribe(self, channel):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        return RedisSubscription(pubsub)
+
+
+class StreamLimiter(object):
+    """Counts the notification streams open in this process, so they can
+    never take every thread of a threaded worker."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.open = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.open >= self.limit:
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.open -= 1
+
+
+def init_broker(app):
+    return RedisBroker(app.redis) if app.redis is not None \
+        else LocalBroker()
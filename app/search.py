@@ -2,38 +2,352 @@
 search.py
 
 We define the search functions we want to use for our Microblog.
-If we happen to stop liking Elasticsearch, we can
-redefine the functions and change the search provider.
+The module level functions delegate to the backend selected by the
+SEARCH_BACKEND setting, so the provider can change without touching
+the models:
+
+- 'elasticsearch' talks to the server at ELASTICSEARCH_URL.
+- 'database' uses the full-text engine of the application database,
+  SQLite FTS5, PostgreSQL tsvector or MySQL FULLTEXT, so search works
+  with no extra service.
 """
 
-from flask import current_app
+import re
+import threading
+from collections import OrderedDict
+from time import monotonic
+import sqlalchemy as sa
+from flask import current_app, g
+from elasticsearch import helpers
+
+
+class SearchBackend(object):
+    """Interface every search provider implements."""
+
+    # Whether index writes can join the application's DB transaction;
+    # otherwise they are deferred to the outbox worker
+    transactional = False
+
+    def add_to_index(self, index, model):
+        payload = {field: getattr(model, field)
+                   for field in model.__searchable__}
+        self.bulk_update_index(index, {model.id: payload}, [])
+
+    def remove_from_index(self, index, model):
+        self.bulk_update_index(index, {}, [model.id])
+
+    def bulk_update_index(self, index, documents, removed_ids):
+        raise NotImplementedError
+
+    def query_index(self, index, query, page, per_page):
+        raise NotImplementedError
+
+    def create_index(self, index):
+        raise NotImplementedError
+
+    def swap_alias(self, alias, index):
+        raise NotImplementedError
+
+
+class ElasticsearchBackend(SearchBackend):
+    def __init__(self, client):
+        self.client = client
+
+    def add_to_index(self, index, model):
+        payload = {}
+        for field in model.__searchable__:
+            payload[field] = getattr(model, field)
+        self.client.index(index=index, id=model.id, document=payload)
+
+    def remove_from_index(self, index, model):
+        self.client.delete(index=index, id=model.id)
+
+    def bulk_update_index(self, index, documents, removed_ids):
+        # documents maps ids to payloads; one bulk request per batch
+        actions = [{'_op_type': 'index', '_index': index, '_id': id,
+                    '_source': payload} for id, payload in documents.items()]
+        actions += [{'_op_type': 'delete', '_index': index, '_id': id}
+                    for id in removed_ids]
+        if not actions:
+            return
+        _, errors = helpers.bulk(self.client, actions,
+                                 raise_on_error=False, ignore_status=(404,))
+        for error in errors:
+            current_app.logger.error('Search bulk error: %s', error)
+
+    def query_index(self, index, query, page, per_page):
+        search = self.client.search(
+            index=index,
+            query={'multi_match': {'query': query, 'fields': ['*']}},
+            from_=(page - 1) * per_page,
+            size=per_page
+        )
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+    def create_index(self, index):
+        # Refreshes are switched off while a fresh index is bulk loaded
+        self.client.indices.create(
+            index=index, settings={'refresh_interval': '-1'})
+
+    def swap_alias(self, alias, index):
+        # Point the alias at the new index in one atomic step, retiring
+        # whatever served the name before, alias or concrete index
+        es = self.client
+        es.indices.put_settings(index=index,
+                                settings={'refresh_interval': None})
+        es.indices.refresh(index=index)
+        actions = [{'add': {'index': index, 'alias': alias}}]
+        retired = []
+        if es.indices.exists_alias(name=alias):
+            retired = [old for old in es.indices.get_alias(name=alias)
+                       if old != index]
+            actions = [{'remove': {'index': old, 'alias': alias}}
+                       for old in retired] + actions
+        elif es.indices.exists(index=alias):
+            actions.insert(0, {'remove_index': {'index': alias}})
+        es.indices.update_aliases(actions=actions)
+        for old in retired:
+            es.indices.delete(index=old)
+
+
+class DatabaseBackend(SearchBackend):
+    """Full-text search inside the application database.
+
+    Each index is a side table ``<index>_fts`` holding one document per
+    row id. Writes go through the current session's connection, so they
+    commit or roll back together with the rows they describe.
+    """
+
+    transactional = True
+
+    def __init__(self):
+        self._ready = set()
+
+    @staticmethod
+    def _connection():
+        return current_app.extensions['sqlalchemy'].session.connection()
+
+    @staticmethod
+    def _table(index):
+        return re.sub(r'\W', '_', index) + '_fts'
+
+    @staticmethod
+    def _terms(query):
+        return re.findall(r'\w+', query.lower())
+
+    def _exists(self, connection, table):
+        if table not in self._ready and \
+                sa.inspect(connection).has_table(table):
+            self._ready.add(table)
+        return table in self._ready
+
+    def _ensure(self, connection, index):
+        table = self._table(index)
+        if table in self._ready:
+            return table
+        dialect = connection.dialect.name
+        if dialect == 'sqlite':
+            connection.execute(sa.text(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {table} '
+                'USING fts5(document)'))
+        elif dialect == 'postgresql':
+            connection.execute(sa.text(
+                f'CREATE TABLE IF NOT EXISTS {table} '
+                '(id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)'))
+            connection.execute(sa.text(
+                f'CREATE INDEX IF NOT EXISTS ix_{table}_document '
+                f'ON {table} USING GIN (document)'))
+        elif dialect in ('mysql', 'mariadb'):
+            # MySQL commits implicitly around DDL, so keep it off the
+            # caller's transaction
+            with current_app.extensions['sqlalchemy'].engine.begin() as \
+                    ddl:
+                ddl.execute(sa.text(
+                    f'CREATE TABLE IF NOT EXISTS {table} '
+                    '(id INTEGER PRIMARY KEY, document TEXT NOT NULL, '
+                    'FULLTEXT (document)) ENGINE=InnoDB'))
+        else:
+            raise RuntimeError(f'No full-text support for {dialect}')
+        self._ready.add(table)
+        return table
+
+    def bulk_update_index(self, index, documents, removed_ids):
+        if not documents and not removed_ids:
+            return
+        connection = self._connection()
+        table = self._ensure(connection, index)
+        key = 'rowid' if connection.dialect.name == 'sqlite' else 'id'
+        stale = list(removed_ids) + list(documents)
+        connection.execute(
+            sa.text(f'DELETE FROM {table} WHERE {key} IN :ids')
+            .bindparams(sa.bindparam('ids', expanding=True)),
+            {'ids': stale})
+        if not documents:
+            return
+        document = 'to_tsvector(\'simple\', :document)' \
+            if connection.dialect.name == 'postgresql' else ':document'
+        connection.execute(
+            sa.text(f'INSERT INTO {table} ({key}, document) '
+                    f'VALUES (:id, {document})'),
+            [{'id': id, 'document': ' '.join(
+                str(value) for value in payload.values() if value)}
+             for id, payload in documents.items()])
+
+    def query_index(self, index, query, page, per_page):
+        terms = self._terms(query)
+        connection = self._connection()
+        table = self._table(index)
+        if not terms or not self._exists(connection, table):
+            return [], 0
+        dialect = connection.dialect.name
+        # Any term may match, as with Elasticsearch's multi_match
+        if dialect == 'sqlite':
+            params = {'q': ' OR '.join(f'"{term}"' for term in terms)}
+            match = f'{table} MATCH :q'
+            key, rank = 'rowid', 'rank'
+        elif dialect == 'postgresql':
+            params = {'q': ' | '.join(terms)}
+            match = 'document @@ to_tsquery(\'simple\', :q)'
+            key = 'id'
+            rank = 'ts_rank(document, to_tsquery(\'simple\', :q)) DESC'
+        else:
+            params = {'q': ' '.join(terms)}
+            match = 'MATCH (document) AGAINST (:q IN NATURAL LANGUAGE MODE)'
+            key, rank = 'id', f'{match} DESC'
+        total = connection.execute(
+            sa.text(f'SELECT count(*) FROM {table} WHERE {match}'),
+            params).scalar()
+        if not total:
+            return [], 0
+        ids = connection.execute(
+            sa.text(f'SELECT {key} FROM {table} WHERE {match} '
+                    f'ORDER BY {rank} LIMIT :limit OFFSET :offset'),
+            dict(params, limit=per_page, offset=(page - 1) * per_page)
+        ).scalars().all()
+        return ids, total
+
+    def create_index(self, index):
+        with current_app.extensions['sqlalchemy'].engine.begin() as \
+                connection:
+            connection.execute(sa.text(
+                f'DROP TABLE IF EXISTS {self._table(index)}'))
+            self._ready.discard(self._table(index))
+            self._ensure(connection, index)
+
+    def swap_alias(self, alias, index):
+        # Runs in the caller's transaction, which commits the swap
+        old, new = self._table(alias), self._table(index)
+        connection = self._connection()
+        connection.execute(sa.text(f'DROP TABLE IF EXISTS {old}'))
+        connection.execute(sa.text(f'ALTER TABLE {new} RENAME TO {old}'))
+        if connection.dialect.name == 'postgresql':
+            connection.execute(sa.text(
+                f'ALTER INDEX ix_{new}_document '
+                f'RENAME TO ix_{old}_document'))
+        self._ready.discard(new)
+        self._ready.add(old)
+
+
+class ResultCache(object):
+    """Size-bounded LRU of query results, each kept for ``ttl`` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def init_search(app):
+    if app.config['SEARCH_BACKEND'] == 'elasticsearch':
+        return ElasticsearchBackend(app.elasticsearch) \
+            if app.elasticsearch else None
+    if app.config['SEARCH_BACKEND'] == 'database':
+        return DatabaseBackend()
+    raise ValueError(f'Unknown search backend '
+                     f'{app.config["SEARCH_BACKEND"]!r}')
 
 
 def add_to_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search:
         return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(
-        index=index, id=model.id, document=payload
-    )
+    current_app.search.add_to_index(index, model)
 
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search:
+        return
+    current_app.search.remove_from_index(index, model)
+
+
+def bulk_update_index(index, documents, removed_ids):
+    if not current_app.search:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    current_app.search.bulk_update_index(index, documents, removed_ids)
 
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    if not current_app.search:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        query={'multi_match': {'query': query, 'fields': ['*']}},
-        from_=(page - 1) * per_page,
-        size=per_page
-    )
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    key = (index, ' '.join(query.lower().split()), page, per_page)
+    result = current_app.search_cache.get(key)
+    g.search_cache_hits = g.get('search_cache_hits', 0) + \
+        (result is not None)
+    g.search_cache_misses = g.get('search_cache_misses', 0) + \
+        (result is None)
+    if result is None:
+        result = current_app.search.query_index(index, query, page,
+                                                per_page)
+        current_app.search_cache.set(key, result)
+    return result
+
+
+def search_cache_stats():
+    # Hits and misses for the current request and for this process
+    cache = current_app.search_cache
+    lookups = cache.hits + cache.misses
+    return {
+        'hits': g.get('search_cache_hits', 0),
+        'misses': g.get('search_cache_misses', 0),
+        'hit_rate': cache.hits / lookups if lookups else 0.0
+    }
+
+
+def create_index(index):
+    current_app.search.create_index(index)
+
+
+def swap_alias(alias, index):
+    current_app.search.swap_alias(alias, index)
@@ -6,13 +6,15 @@ We set up functions to be sent to the Celery queue
 
 from flask import current_app, render_template
 from celery import shared_task
-import time
-from app.models import db, Task, User, Post
+from celery.signals import worker_init
+import os
+import gzip
+from app.models import db, Task, User, Post, Outbox, Notification
 from app.email import send_email
+from app.language import warm_up, detect_language, detect_languages
 import sys
 import sqlalchemy as sa
 import json
-from celery.result import AsyncResult
 from celery.contrib import rdb
 
 
@@ -25,65 +27,162 @@ from celery.contrib import rdb
 
 
 def _set_task_progress(celery_task, progress):
-    try:
-        celery_task.update_state(state='PROGRESS',
-                                 meta={'current': progress}
-                                 )
-
-        task = db.session.get(Task, celery_task.request.id)
-        task.user.add_notification(
-            'task_progress',
-            {
-                'task_id': celery_task.request.id,
-                'progress': progress
-            }
-        )
-        if progress >= 100:
-            task.complete = True
-        db.session.commit()
-    except Exception:
+    # Only report progress that moved by at least TASK_PROGRESS_STEP
+    last = getattr(celery_task.request, 'reported_progress', None)
+    if last is not None and (progress == last or (
+            progress < 100 and
+            progress - last < current_app.config['TASK_PROGRESS_STEP'])):
+        return
+    celery_task.request.reported_progress = progress
+    # Progress lives on the Task row, so pages read it with the task list
+    task = db.session.get(Task, celery_task.request.id)
+    if task is None:
+        return
+    task.progress = progress
+    if progress >= 100:
         task.complete = True
-        db.session.commit()
+        User._adjust_counters(task.user_id, version=1)
+    task.user.add_notification(
+        'task_progress',
+        {
+            'task_id': celery_task.request.id,
+            'progress': progress
+        },
+        # The final update must never be throttled away
+        min_interval=0 if progress >= 100 else None
+    )
+    db.session.commit()
+
+
+# Push a new post into its readers' home timelines
+@shared_task(ignore_result=True)
+def fan_out_post(post_id):
+    post = db.session.get(Post, post_id)
+    if post is None:
+        return
+    post.fan_out()
+    db.session.commit()
+
+
+# fan_out_post() for a batch of posts created through the API
+@shared_task(ignore_result=True)
+def fan_out_posts(post_ids):
+    Post.fan_out_many(post_ids)
+    db.session.commit()
+
+
+# Refill followers' timelines for authors back under the fan-out limit
+@shared_task(ignore_result=True)
+def backfill_followers(author_ids):
+    User.backfill_followers(author_ids)
+    db.session.commit()
+
+
+# Load the language profiles before the pool forks
+@worker_init.connect
+def _warm_up_language_detector(**kwargs):
+    warm_up()
+
+
+# Detect the language of a new post after it has been committed
+@shared_task(ignore_result=True)
+def detect_post_language(post_id):
+    body = db.session.scalar(sa.select(Post.body).where(Post.id == post_id))
+    if body is None:
+        return
+    Post.set_languages({post_id: detect_language(body)})
+    db.session.commit()
+
+
+# detect_post_language() for a batch of posts, stored in one pass
+@shared_task(ignore_result=True)
+def detect_post_languages(post_ids):
+    posts = db.session.execute(
+        sa.select(Post.id, Post.body).where(Post.id.in_(post_ids))).all()
+    Post.set_languages(dict(detect_languages(posts)))
+    db.session.commit()
+
+
+# Apply the side effects recorded in the transactional outbox
+@shared_task(ignore_result=True)
+def drain_outbox():
+    Outbox.drain()
+
+
+# Drop notifications nobody has picked up in NOTIFICATION_RETENTION
+@shared_task(ignore_result=True)
+def purge_notifications():
+    Notification.purge(current_app.config['NOTIFICATION_RETENTION'])
+
+
+# Forget tasks that have finished
+@shared_task(ignore_result=True)
+def sweep_tasks():
+    Task.sweep()
+
+
+# Keep home timelines to the newest TIMELINE_LENGTH pushed posts
+@shared_task(ignore_result=True)
+def trim_timelines():
+    User.trim_timelines(current_app.config['TIMELINE_LENGTH'])
+
+
+def export_path(user_id):
+    # Each user keeps only their most recent export
+    return os.path.join(current_app.config['EXPORT_FOLDER'],
+                        f'posts-{user_id}.ndjson.gz')
 
 
 # Implement the Export task
 @shared_task(bind=True)
-def export_posts(self, user_id):
+def export_posts(self, user_id, download_url=None):
+    path = export_path(user_id)
+    spool = f'{path}.{self.request.id}.part'
     try:
-        # read user posts
+        # Stream the posts in chunks to a gzipped NDJSON spool file
         user = db.session.get(User, user_id)
         _set_task_progress(self, 0)
-        data = []
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        total_posts = user.post_count()
+        chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
         counter = 0
-        total_posts = db.session.scalar(
-                sa.select(
-                    sa.func.count()
-                ).select_from(
-                    user.posts.select().subquery()
-                )
-        )
-        for post in db.session.scalars(
-            user.posts.select().order_by(
-                Post.timestamp.asc()
-                )
-        ):
-            data.append({'body': post.body,
-                        'timestamp': post.timestamp.isoformat() + 'Z'})
-            time.sleep(5)
-            counter = counter + 1
-            _set_task_progress(self, (100 * counter) // total_posts)
+        query = (sa.select(Post.id, Post.body, Post.timestamp)
+                 .where(Post.user_id == user_id)
+                 .order_by(Post.timestamp.asc(), Post.id.asc())
+                 .limit(chunk_size))
+        # Each chunk is a keyset query of its own, so no cursor is left
+        # open while progress is committed
+        with gzip.open(spool, 'wt', encoding='utf-8') as f:
+            chunk = db.session.execute(query).all()
+            while chunk:
+                for _id, body, timestamp in chunk:
+                    f.write(json.dumps(
+                        {'body': body,
+                         'timestamp': timestamp.isoformat() + 'Z'}) + '\n')
+                counter += len(chunk)
+                if total_posts:
+                    _set_task_progress(
+                        self, min(99, (100 * counter) // total_posts))
+                last_id, _body, last_timestamp = chunk[-1]
+                chunk = db.session.execute(query.where(sa.or_(
+                    Post.timestamp > last_timestamp,
+                    sa.and_(Post.timestamp == last_timestamp,
+                            Post.id > last_id)))).all()
+        os.replace(spool, path)
         # send email
         send_email(
             '[Microblog] Your blog posts',
             sender=current_app.config['ADMINS'][0], recipients=[user.email],
-            text_body=render_template('email/export_posts.txt', user=user),
-            html_body=render_template('email/export_posts.html', user=user),
-            attachments=[('posts.json', 'application/json',
-                          json.dumps({'posts': data}, indent=4))],
+            text_body=render_template('email/export_posts.txt', user=user,
+                                      download_url=download_url),
+            html_body=render_template('email/export_posts.html', user=user,
+                                      download_url=download_url),
             sync=True)
 
     except Exception:
         # Handle exceptions
+        if os.path.exists(spool):
+            os.remove(spool)
         _set_task_progress(self, 100)
         current_app.logger.error('Unhandled exception',
                                  exc_info=sys.exc_info())
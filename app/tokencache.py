@@ -0,0 +1,55 @@
+"""
+tokencache.py
+
+Cache of API token -> (user id, expiry) so authenticated API requests
+do not have to look the token up in the database. Entries live in Redis
+when it is configured, where a revocation reaches every worker at once;
+otherwise in process memory, where other workers may keep honouring a
+revoked token for at most TOKEN_CACHE_TTL seconds.
+"""
+
+import hashlib
+import json
+from time import time
+from .search import ResultCache
+
+
+class TokenCache(object):
+    def __init__(self, app):
+        self.redis = app.redis
+        self.ttl = app.config['TOKEN_CACHE_TTL']
+        self.local = ResultCache(app.config['TOKEN_CACHE_SIZE'], self.ttl)
+
+    @staticmethod
+    def _key(token):
+        # Only a digest of the token is ever stored
+        return 'microblog:token:' + hashlib.sha256(
+            token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        """Return (user_id, expiry) for a cached token, else None."""
+        key = self._key(token)
+        if self.redis is None:
+            return self.local.get(key)
+        entry = self.redis.get(key)
+        return tuple(json.loads(entry)) if entry is not None else None
+
+    def set(self, token, user_id, expiry):
+        ttl = min(self.ttl, int(expiry - time()))
+        if ttl <= 0:
+            return
+        key = self._key(token)
+        if self.redis is None:
+            self.local.set(key, (user_id, expiry))
+        else:
+            self.redis.set(key, json.dumps([user_id, expiry]), ex=ttl)
+
+    def invalidate(self, *tokens):
+        keys = [self._key(token) for token in tokens if token]
+        if not keys:
+            return
+        if self.redis is None:
+            for key in keys:
+                self.local.delete(key)
+        else:
+            self.redis.delete(*keys)
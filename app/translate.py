@@ -1,33 +1,228 @@
 """
 Text translation function
+
+Translations are looked up in an in-process LRU, then in the
+translation table, and only then requested from the translator
+configured for the app, grouped by source language into as few calls
+as its limits allow. Concurrent requests for the same text share a
+single upstream call.
 """
 
+import hashlib
+import threading
+from concurrent.futures import Future
 import requests
+from requests.adapters import HTTPAdapter
+import sqlalchemy as sa
 from flask_babel import _
 from flask import current_app
-from config import Config
+from app.models import db, Translation
+
+
+class TranslationError(Exception):
+    pass
+
+
+class Translator(object):
+    """Interface every translation provider implements."""
+
+    # Upstream limits on a single request
+    max_texts = 1000
+    max_chars = 50000
+
+    def translate(self, texts, source_language, dest_language):
+        """Return the translations of ``texts``, in order."""
+        raise NotImplementedError
+
+
+class MicrosoftTranslator(Translator):
+    url = 'https://api.cognitive.microsofttranslator.com/translate'
+
+    def __init__(self, key, location, timeout=5, pool_size=10):
+        self.timeout = timeout
+        # One pooled session keeps TLS connections alive between calls
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=1))
+        self.session.headers.update({
+            'Ocp-Apim-Subscription-Key': key,
+            'Ocp-Apim-Subscription-Region': location,
+        })
+
+    def translate(self, texts, source_language, dest_language):
+        try:
+            r = self.session.post(
+                self.url,
+                params={'api-version': '3.0', 'from': source_language,
+                        'to': dest_language},
+                json=[{'Text': text} for text in texts],
+                timeout=self.timeout
+            )
+        except requests.RequestException as e:
+            raise TranslationError(str(e)) from e
+        if r.status_code != 200:
+            raise TranslationError(f'HTTP {r.status_code}')
+        try:
+            return [item['translations'][0]['text'] for item in r.json()]
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise TranslationError('Malformed response') from e
+
+
+def init_translator(app):
+    if not app.config.get('MS_TRANSLATOR_KEY'):
+        return None
+    return MicrosoftTranslator(app.config['MS_TRANSLATOR_KEY'],
+                               app.config['MS_TRANSLATOR_LOCATION'],
+                               timeout=app.config['TRANSLATOR_TIMEOUT'])
+
+
+def _text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _chunks(texts, translator):
+    # Split one language's texts into requests within the upstream limits
+    chunk, size = [], 0
+    for key, text in texts:
+        if chunk and (len(chunk) == translator.max_texts or
+                      size + len(text) > translator.max_chars):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append((key, text))
+        size += len(text)
+    if chunk:
+        yield chunk
+
+
+# Upstream calls in flight, so identical requests can wait on them
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def _load(missing):
+    # One query per source language for the texts not in process memory
+    found = {}
+    by_source = {}
+    for key in missing:
+        by_source.setdefault(key[1:], []).append(key[0])
+    for (source, dest), hashes in by_source.items():
+        for start in range(0, len(hashes), 500):
+            found.update(
+                ((text_hash, source, dest), translation)
+                for text_hash, translation in db.session.execute(
+                    sa.select(Translation.text_hash,
+                              Translation.translation).where(
+                        Translation.source_language == source,
+                        Translation.dest_language == dest,
+                        Translation.text_hash.in_(
+                            hashes[start:start + 500])))
+            )
+    return found
+
+
+def _store(translations):
+    # Stored on a connection of its own, outside the request transaction
+    rows = [{'text_hash': key[0], 'source_language': key[1],
+             'dest_language': key[2], 'translation': translation}
+            for key, translation in translations.items()]
+    insert = Translation.__table__.insert()
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(insert, rows)
+    except sa.exc.IntegrityError:
+        # Another worker stored some of them first; keep the rest
+        for row in rows:
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(insert, row)
+            except sa.exc.IntegrityError:
+                pass
+
+
+def _fetch(owned, dest_language):
+    """Translate the texts in ``owned``, a mapping of keys to texts and
+    futures, grouping them by source language."""
+    translator = current_app.translator
+    by_source = {}
+    for key, (text, _future) in owned.items():
+        by_source.setdefault(key[1], []).append((key, text))
+    fetched = {}
+    for source, texts in by_source.items():
+        for chunk in _chunks(texts, translator):
+            try:
+                translations = translator.translate(
+                    [text for _key, text in chunk], source, dest_language)
+            except Exception as e:
+                current_app.logger.warning('Translation failed: %s', e)
+                for key, _text in chunk:
+                    owned[key][1].set_exception(e)
+                continue
+            for (key, _text), translation in zip(chunk, translations):
+                current_app.translation_cache.set(key, translation)
+                owned[key][1].set_result(translation)
+                fetched[key] = translation
+    return fetched
+
+
+def translate_many(texts, dest_language):
+    """Translate ``texts``, a list of (text, source_language) pairs.
+
+    Cached translations are reused, and the rest are requested in as
+    few upstream calls as the translator's limits allow. Texts that
+    could not be translated come back as an error message.
+    """
+    if current_app.translator is None:
+        return [_('Error: the translation service is not configured.')] * \
+            len(texts)
+    keys = [(_text_hash(text), source, dest_language)
+            for text, source in texts]
+    results, missing = {}, {}
+    for key, (text, _source) in zip(keys, texts):
+        if key in results or key in missing:
+            continue
+        translation = current_app.translation_cache.get(key)
+        if translation is None:
+            missing[key] = text
+        else:
+            results[key] = translation
+    if missing:
+        loaded = _load(missing)
+        for key, translation in loaded.items():
+            current_app.translation_cache.set(key, translation)
+            del missing[key]
+        results.update(loaded)
+
+    # Claim the texts nobody is translating yet; wait for the others
+    owned, waiting = {}, {}
+    with _pending_lock:
+        for key, text in missing.items():
+            if key in _pending:
+                waiting[key] = _pending[key]
+            else:
+                owned[key] = (text, Future())
+                _pending[key] = owned[key][1]
+    try:
+        fetched = _fetch(owned, dest_language) if owned else {}
+    finally:
+        with _pending_lock:
+            for key, (_text, future) in owned.items():
+                if not future.done():
+                    future.set_exception(TranslationError('Not translated'))
+                del _pending[key]
+    results.update(fetched)
+    if fetched:
+        _store(fetched)
+    for key, future in waiting.items():
+        try:
+            results[key] = future.result(
+                timeout=current_app.config['TRANSLATOR_TIMEOUT'] * 2)
+        except Exception:
+            pass
+    if len(results) < len(set(keys)):
+        failed = _('Error: the translation service failed.')
+        return [results.get(key, failed) for key in keys]
+    return [results[key] for key in keys]
 
 
 def translate(text, source_language, dest_language):
-    if ('MS_TRANSLATOR_KEY' not in current_app.config) or (
-            not current_app.config['MS_TRANSLATOR_KEY']
-    ):
-        return _('Error: the translation service is not configured.')
-    auth = {
-            'Ocp-Apim-Subscription-Key':
-            current_app.config['MS_TRANSLATOR_KEY'],
-            'Ocp-Apim-Subscription-Region':
-            current_app.config['MS_TRANSLATOR_LOCATION'],
-            #'Content-Type': 'application/json; charset=UTF-8'
-    }
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language),
-        headers=auth, json=[{'Text': text}]
-    )
-    print(r.status_code)
-    print(r.json)
-    if r.status_code != 200:
-        return _('Error: the translation service failed.')
-    return r.json()[0]['translations'][0]['text']
+    return translate_many([(text, source_language)], dest_language)[0]
@@ -0,0 +1,110 @@
+"""
+JSON encoding benchmark.
+
+Times Flask's default JSON provider against the orjson provider on a
+page of serialized users, then compares building a large collection as
+one JSON document with streaming it as NDJSON, in time and peak memory.
+
+    $ python benchmarks/json_encoding.py --users 20000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sqlalchemy as sa  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+from config import Config  # noqa: E402
+from app import create_app  # noqa: E402
+from app.jsonprovider import OrjsonProvider, orjson  # noqa: E402
+from app.models import db, User  # noqa: E402
+
+
+def make_config(path):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+    return BenchConfig
+
+
+def load_users(count):
+    rows = [{'username': f'user{i}', 'email': f'user{i}@example.com',
+             'about_me': 'Hi, I am user number %d' % i}
+            for i in range(count)]
+    db.session.execute(sa.insert(User.__table__), rows)
+    db.session.commit()
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def encoders(app, per_page, repeat):
+    page = User.to_collection_dict(sa.select(User), User.id, per_page,
+                                   'api.users.get_users')
+    for name, provider in (('default', DefaultJSONProvider(app)),
+                           ('orjson', OrjsonProvider(app))):
+        elapsed = best_of(lambda: provider.response(page), repeat)
+        print(f'{name:>8}: {per_page} users in {elapsed * 1000:.2f} ms, '
+              f'{per_page / elapsed:,.0f} users/s')
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = fn()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db.session.expunge_all()
+    return size, elapsed, peak
+
+
+def collections(app, count):
+    def document():
+        page = User.to_collection_dict(sa.select(User), User.id, count,
+                                       'api.users.get_users')
+        return len(app.json.response(page).get_data())
+
+    def stream():
+        return sum(len(chunk.encode('utf-8'))
+                   for chunk in User.to_collection_stream(
+                       sa.select(User), User.id, count,
+                       'api.users.get_users',
+                       chunk_size=app.config['API_STREAM_CHUNK_SIZE']))
+
+    for name, fn in (('document', document), ('ndjson', stream)):
+        size, elapsed, peak = measure(fn)
+        print(f'{name:>8}: {count} users, {size / 1e6:.1f} MB in '
+              f'{elapsed:.2f} s, peak memory {peak / 1e6:.1f} MB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--per-page', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    if orjson is None:
+        sys.exit('orjson is not installed')
+    with tempfile.TemporaryDirectory() as scratch:
+        app = create_app(make_config(os.path.join(scratch, 'bench.db')))
+        with app.app_context():
+            db.create_all()
+            load_users(args.users)
+        with app.test_request_context('/api/users/'):
+            encoders(app, args.per_page, args.repeat)
+            collections(app, args.users)
+
+
+if __name__ == '__main__':
+    main()
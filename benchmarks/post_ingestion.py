@@ -0,0 +1,105 @@
+"""
+Post ingestion benchmark.
+
+Creates posts in a scratch SQLite database through the home page form,
+one request per post, and through POST /api/posts/batch, and compares
+their throughput. Follow-up work is only recorded in the outbox, whose
+drain is queued on an in-memory broker; the language detection it
+defers is timed on its own afterwards.
+
+    $ python benchmarks/post_ingestion.py --posts 20000
+"""
+
+import argparse
+import base64
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sqlalchemy as sa  # noqa: E402
+from config import Config  # noqa: E402
+from app import create_app  # noqa: E402
+from app.models import db, User, Post  # noqa: E402
+from app.tasks import detect_post_languages  # noqa: E402
+
+WORDS = ('the quick brown fox jumps over a lazy dog while we write posts '
+         'about flask python databases and the weather today').split()
+
+
+def make_config(path):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        WTF_CSRF_ENABLED = False
+        CELERY = dict(broker_url='memory://', task_ignore_result=True)
+    return BenchConfig
+
+
+def make_posts(count):
+    return [{'body': ' '.join(random.choices(WORDS, k=10))}
+            for _ in range(count)]
+
+
+def form(client, posts):
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    start = time.perf_counter()
+    for post in posts:
+        client.post('/index', data={'post': post['body']})
+    return time.perf_counter() - start
+
+
+def batch(client, posts, size):
+    token = client.post('/api/tokens/', headers={
+        'Authorization': 'Basic ' + base64.b64encode(
+            b'bench:bench').decode()}).json['token']
+    headers = {'Authorization': f'Bearer {token}'}
+    start = time.perf_counter()
+    for offset in range(0, len(posts), size):
+        response = client.post('/api/posts/batch', headers=headers,
+                               json={'posts': posts[offset:offset + size]})
+        assert response.status_code == 201, response.json
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--form-posts', type=int, default=500,
+                        help='Posts created through the form.')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='Posts per batch request.')
+    args = parser.parse_args()
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as scratch:
+        app = create_app(make_config(os.path.join(scratch, 'bench.db')))
+        with app.app_context():
+            db.create_all()
+            user = User(username='bench', email='bench@example.com')
+            user.set_password('bench')
+            db.session.add(user)
+            db.session.commit()
+
+        elapsed = form(app.test_client(), make_posts(args.form_posts))
+        single = args.form_posts / elapsed
+        print(f'    form: {args.form_posts} posts in {elapsed:.2f} s, '
+              f'{single:,.0f} posts/s')
+        elapsed = batch(app.test_client(), make_posts(args.posts),
+                        args.batch_size)
+        bulk = args.posts / elapsed
+        print(f'   batch: {args.posts} posts in {elapsed:.2f} s, '
+              f'{bulk:,.0f} posts/s ({bulk / single:.0f}x)')
+
+        with app.app_context():
+            ids = db.session.scalars(sa.select(Post.id)).all()
+            start = time.perf_counter()
+            detect_post_languages.apply(args=(ids,))
+            elapsed = time.perf_counter() - start
+        print(f'language: {len(ids)} posts in {elapsed:.2f} s, '
+              f'{len(ids) / elapsed:,.0f} posts/s per worker process')
+
+
+if __name__ == '__main__':
+    main()
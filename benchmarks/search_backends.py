@@ -0,0 +1,92 @@
+"""
+Search backend benchmark.
+
+Loads synthetic posts into a scratch SQLite database, rebuilds the index
+with each backend and times a set of queries against it. Elasticsearch
+is included when ELASTICSEARCH_URL is set.
+
+    $ python benchmarks/search_backends.py --posts 20000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sqlalchemy as sa  # noqa: E402
+from config import Config  # noqa: E402
+from app import create_app  # noqa: E402
+from app.models import db, User, Post  # noqa: E402
+
+WORDS = ('flask python search index query database post blog user '
+         'message follow timeline cache worker queue celery redis elastic '
+         'translate language export token password avatar profile').split()
+
+
+def make_config(backend, path):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        SEARCH_BACKEND = backend
+    return BenchConfig
+
+
+def load_posts(count):
+    user = User(username='bench', email='bench@example.com')
+    db.session.add(user)
+    db.session.commit()
+    now = datetime.now(timezone.utc)
+    rows = [{'body': ' '.join(random.choices(WORDS, k=8)),
+             'user_id': user.id, 'timestamp': now}
+            for _ in range(count)]
+    # Core insert, so the rows are only indexed by the timed reindex
+    db.session.execute(sa.insert(Post.__table__), rows)
+    db.session.commit()
+
+
+def run(backend, path, queries):
+    app = create_app(make_config(backend, path))
+    with app.app_context():
+        if app.search is None:
+            print(f'{backend}: not configured, skipped')
+            return
+        start = time.perf_counter()
+        total = Post.reindex()
+        elapsed = time.perf_counter() - start
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            Post.search(query, 1, 25)
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        print(f'{backend:>13}: indexed {total} rows at '
+              f'{total / elapsed:,.0f} rows/s; query p50 '
+              f'{statistics.median(timings):.2f} ms, p95 '
+              f'{timings[int(len(timings) * 0.95)]:.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+    random.seed(0)
+    queries = [' '.join(random.sample(WORDS, 2))
+               for _ in range(args.queries)]
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(scratch, 'bench.db')
+        app = create_app(make_config('database', path))
+        with app.app_context():
+            db.create_all()
+            load_posts(args.posts)
+        for backend in ('database', 'elasticsearch'):
+            run(backend, path, queries)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,4 +7,6 @@ while true; do
 	echo Upgrade command failed, retrying in 5 seconds...
 	sleep 5
 done
-exec gunicorn -b :5000 --access-logfile - --error-logfile - microblog:app
+# Notification streams hold a thread each; NOTIFICATIONS_MAX_STREAMS
+# (10 by default) keeps them well below the 25 threads
+exec gunicorn -b :5000 -k gthread --threads 25 --access-logfile - --error-logfile - microblog:app
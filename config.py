@@ -29,9 +29,42 @@ class Config:
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['agustin90m@gmail.com']
+    # Outgoing mail is queued and sent by a fixed pool of workers, each
+    # sending up to MAIL_BATCH_SIZE messages per SMTP connection
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_QUEUE_TIMEOUT = float(os.environ.get('MAIL_QUEUE_TIMEOUT') or 5)
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 50)
 
     # Pagination
     POSTS_PER_PAGE = 25
+    # API collections streamed as NDJSON may ask for much larger pages,
+    # read from a server-side cursor this many rows at a time
+    API_STREAM_MAX_PER_PAGE = int(
+        os.environ.get('API_STREAM_MAX_PER_PAGE') or 10000)
+    API_STREAM_CHUNK_SIZE = int(
+        os.environ.get('API_STREAM_CHUNK_SIZE') or 500)
+
+    # Most posts one batch API request may create, and the posts
+    # inserted, indexed and committed together
+    POST_BATCH_LIMIT = int(os.environ.get('POST_BATCH_LIMIT') or 5000)
+    POST_BATCH_CHUNK_SIZE = int(os.environ.get('POST_BATCH_CHUNK_SIZE') or 500)
+
+    # JSON encoder, 'orjson' when it is installed or Flask's 'default'
+    JSON_PROVIDER = os.environ.get('JSON_PROVIDER') or 'orjson'
+
+    # Render post lists from projected __slots__ rows instead of full
+    # ORM objects
+    POST_LIST_ROWS = os.environ.get('POST_LIST_ROWS', '1') != '0'
+
+    # Home timeline fan-out. Authors with more followers than the limit
+    # are merged in at read time instead of being pushed to every follower
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT')
+                                or 10000)
+    TIMELINE_BACKFILL = int(os.environ.get('TIMELINE_BACKFILL') or 500)
+    # Pushed posts kept per home timeline; older ones are trimmed by
+    # celery beat
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 1000)
 
     # Supported languages via Flask-Babel
     LANGUAGES = ['en', 'es']
@@ -39,16 +72,92 @@ class Config:
     # Microsoft translator API key
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
     MS_TRANSLATOR_LOCATION = os.environ.get('MS_TRANSLATOR_LOCATION')
+    TRANSLATOR_TIMEOUT = float(os.environ.get('TRANSLATOR_TIMEOUT') or 5)
+    # Most posts a single batch translation request may ask for
+    TRANSLATE_BATCH_LIMIT = 100
+    # Recent translations kept in process, in front of the database
+    TRANSLATION_CACHE_SIZE = int(
+        os.environ.get('TRANSLATION_CACHE_SIZE') or 4096)
 
     # Elasticsearch
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
 
+    # Search provider, 'elasticsearch' or the built-in 'database' engine
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or (
+        'elasticsearch' if ELASTICSEARCH_URL else 'database')
+    # Result ids of recent queries, per process
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1024)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 30)
+
+    # Redis, shared by the workers for buffers and caches when available
+    REDIS_URL = os.environ.get('REDIS_URL')
+
+    # Password hashes computed at once per process, and the most that
+    # may wait or run before new requests are turned away with 503
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 8)
+
+    # Verified API tokens are cached for up to this many seconds
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 60)
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 10000)
+
+    # last_seen is buffered and written back in batches. A stored value
+    # younger than the staleness window is not refreshed at all
+    LAST_SEEN_STALENESS = int(os.environ.get('LAST_SEEN_STALENESS') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(
+        os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 30)
+
+    # Server-sent notification stream. Streams are closed after the
+    # timeout and the browser reconnects, so a worker is never held for
+    # long; heartbeats keep proxies from dropping idle streams
+    NOTIFICATIONS_STREAM_TIMEOUT = int(
+        os.environ.get('NOTIFICATIONS_STREAM_TIMEOUT') or 300)
+    NOTIFICATIONS_HEARTBEAT = int(
+        os.environ.get('NOTIFICATIONS_HEARTBEAT') or 15)
+    # Most streams open at once per process. Each holds a thread, so
+    # threaded workers need this well below their thread count; past it
+    # browsers are told to poll instead. The gevent stream server in
+    # deployment/ raises it
+    NOTIFICATIONS_MAX_STREAMS = int(
+        os.environ.get('NOTIFICATIONS_MAX_STREAMS') or 10)
+
+    # Post exports are spooled here and offered as downloads
+    EXPORT_FOLDER = os.environ.get('EXPORT_FOLDER') or \
+        os.path.join(basedir, 'exports')
+    EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE') or 1000)
+
+    # Minimum seconds between stored notifications of the same name;
+    # task progress is further limited to TASK_PROGRESS_STEP percent
+    NOTIFICATION_THROTTLE = {'task_progress': 1.0}
+    TASK_PROGRESS_STEP = int(os.environ.get('TASK_PROGRESS_STEP') or 5)
+    # Notifications older than this many seconds are purged by celery beat
+    NOTIFICATION_RETENTION = int(
+        os.environ.get('NOTIFICATION_RETENTION') or 7 * 24 * 3600)
+
     # Celery
     CELERY = dict(
         broker_url="redis://localhost:6379/0",
         result_backend="redis://localhost:6379/0",
         task_ignore_result=True,
-        task_track_started=True
+        task_track_started=True,
+        beat_schedule={
+            'drain-outbox': {
+                'task': 'app.tasks.drain_outbox',
+                'schedule': 60.0,
+            },
+            'purge-notifications': {
+                'task': 'app.tasks.purge_notifications',
+                'schedule': 3600.0,
+            },
+            'sweep-tasks': {
+                'task': 'app.tasks.sweep_tasks',
+                'schedule': 3600.0,
+            },
+            'trim-timelines': {
+                'task': 'app.tasks.trim_timelines',
+                'schedule': 3600.0,
+            },
+        }
     )
 
     def __class_getitem__(self, item):
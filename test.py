@@ -3,9 +3,35 @@ User model unit tests for Microblog.
 """
 
 from datetime import datetime, timezone, timedelta
+import base64
+import gzip
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 from app import create_app
-from app.models import db, User, Post
+from app.models import (db, User, Post, Outbox, Notification, Task,
+                        TokenUser, SearchReindex, timeline)
+from app.tasks import (export_posts, export_path, detect_post_language,
+                       detect_post_languages, fan_out_posts,
+                       backfill_followers)
+from app.language import detect_language
+from app.background import PerProcess
+from app.email import MailQueue
+from app.hashing import password_hasher, PasswordHashBusy
+from app.jsonprovider import OrjsonProvider
+from app.pagination import keyset_paginate
+from app.presence import LastSeenBuffer
+from app.pubsub import LocalBroker, RedisBroker
+from app.search import ElasticsearchBackend, ResultCache
+from app.translate import Translator, translate, translate_many
+import sqlalchemy as sa
+from aiosmtpd.controller import Controller
+from flask_mail import Message as MailMessage
 from config import Config
 
 
@@ -31,6 +57,9 @@ class UserModelCase(unittest.TestCase):
         db.drop_all()
         self.app_context.pop()
 
+    def home(self, user, per_page=100):
+        return [post.id for post in user.home_timeline(per_page).items]
+
     def test_password_hashing(self):
         u = User(username='susan', email='susan@example.com')
         u.set_password('cat')
@@ -99,14 +128,1085 @@ class UserModelCase(unittest.TestCase):
         db.session.commit()
 
         # check the following posts of each user
-        f1 = db.session.scalars(u1.following_posts()).all()
-        f2 = db.session.scalars(u2.following_posts()).all()
-        f3 = db.session.scalars(u3.following_posts()).all()
-        f4 = db.session.scalars(u4.following_posts()).all()
-        self.assertEqual(f1, [p2, p4, p1])
-        self.assertEqual(f2, [p2, p3])
-        self.assertEqual(f3, [p3, p4])
-        self.assertEqual(f4, [p4])
+        self.assertEqual(self.home(u1), [p2.id, p4.id, p1.id])
+        self.assertEqual(self.home(u2), [p2.id, p3.id])
+        self.assertEqual(self.home(u3), [p3.id, p4.id])
+        self.assertEqual(self.home(u4), [p4.id])
+
+    def test_timeline_fan_out(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        u3.follow(u2)
+        db.session.commit()
+
+        # A new post only reaches followers once it is fanned out
+        p1 = Post(body="post from susan", author=u2)
+        db.session.add(p1)
+        db.session.commit()
+        self.assertEqual(self.home(u1), [])
+        p1.fan_out()
+        db.session.commit()
+        self.assertEqual(self.home(u1), [p1.id])
+
+        # Unfollowing prunes the timeline
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(self.home(u1), [])
+
+        # High-follower authors are merged at read time
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        u1.follow(u2)
+        p2 = Post(body="another post from susan", author=u2,
+                  timestamp=p1.timestamp + timedelta(seconds=1))
+        db.session.add(p2)
+        db.session.commit()
+        p2.fan_out()
+        db.session.commit()
+        self.assertEqual(self.home(u1), [p2.id, p1.id])
+        self.assertEqual(self.home(u3), [p2.id, p1.id])
+
+    def test_fan_out_limit_drop(self):
+        users = [User(username=name, email=f'{name}@example.com')
+                 for name in ('susan', 'john', 'mary', 'david')]
+        db.session.add_all(users)
+        db.session.commit()
+        susan, john, mary, david = users
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 2
+        for u in (john, mary, david):
+            u.follow(susan)
+        db.session.commit()
+
+        # Susan's post is merged on read while she is above the limit
+        p = Post(body='post from susan', author=susan)
+        db.session.add(p)
+        db.session.commit()
+        p.fan_out()
+        db.session.commit()
+        self.assertEqual(self.home(john), [p.id])
+
+        # Once she drops back to the limit it is pushed instead
+        with mock.patch('app.models.celery_app.send_task') as send:
+            david.unfollow(susan)
+            db.session.commit()
+            self.assertEqual(self.home(john), [])
+            send.reset_mock()
+            Outbox.drain()
+        send.assert_called_once_with('app.tasks.backfill_followers',
+                                     args=[[susan.id]], ignore_result=True)
+        backfill_followers.apply(args=([susan.id],))
+        self.assertEqual(self.home(john), [p.id])
+        self.assertEqual(self.home(mary), [p.id])
+        self.assertEqual(self.home(david), [])
+
+    def test_home_timeline_pages(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        u4 = User(username='david', email='david@example.com')
+        db.session.add_all([u1, u2, u3, u4])
+        db.session.commit()
+        # Susan's posts are pushed, Mary's merged on read
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        u1.follow(u2)
+        u1.follow(u3)
+        u4.follow(u3)
+        db.session.commit()
+        now = datetime(2024, 1, 1)
+        posts = []
+        for i in range(12):
+            post = Post(body=f'post {i}', author=(u1, u2, u3)[i % 3],
+                        timestamp=now + timedelta(minutes=i // 2))
+            db.session.add(post)
+            db.session.commit()
+            post.fan_out()
+            db.session.commit()
+            posts.append(post)
+        expected = [post.id for post in sorted(
+            posts, key=lambda p: (p.timestamp, p.id), reverse=True)]
+
+        # Walk forwards and back again with the cursors
+        page = u1.home_timeline(5)
+        pages = [page]
+        while page.next_args:
+            page = u1.home_timeline(5, **page.next_args)
+            pages.append(page)
+        self.assertEqual([post.id for page in pages for post in page.items],
+                         expected)
+        self.assertEqual([len(page.items) for page in pages], [5, 5, 2])
+        page = u1.home_timeline(5, **pages[-1].prev_args)
+        self.assertEqual([post.id for post in page.items], expected[5:10])
+
+        # Trimming keeps the newest pushed posts
+        self.assertEqual(User.trim_timelines(2), 2)
+        pushed = [post.id for post in posts if post.author == u2]
+        self.assertEqual(
+            db.session.scalars(sa.select(timeline.c.post_id).where(
+                timeline.c.user_id == u1.id).order_by(
+                timeline.c.post_id)).all(), pushed[-2:])
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        db.session.add_all([Post(body='one', author=u1),
+                            Post(body='two', author=u1)])
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual(u1.post_count(), 2)
+        self.assertEqual(u1.followers_count(), 1)
+        self.assertEqual(u2.following_count(), 1)
+
+        # Drifted counters are repaired from the source tables
+        u1.num_posts = 7
+        db.session.commit()
+        self.assertEqual(User.repair_counters(), 1)
+        db.session.commit()
+        self.assertEqual(u1.post_count(), 2)
+
+    def test_unread_message_counter(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        sender = self.app.test_client()
+        with sender.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+        reader = self.app.test_client()
+        with reader.session_transaction() as session:
+            session['_user_id'] = str(u2.id)
+
+        def notification():
+            return db.session.scalar(u2.notifications.select().where(
+                Notification.name == 'unread_message_count')).get_data()
+
+        # Every message bumps the stored counter, which the notification
+        # carries
+        for count in (1, 2):
+            # A context per request, so the logged in user is not kept in g
+            with self.app.app_context():
+                response = sender.post('/send_message/susan',
+                                       data={'message': f'hello {count}'})
+            self.assertEqual(response.status_code, 302)
+            db.session.expire_all()
+            self.assertEqual(u2.num_unread_messages, count)
+            self.assertEqual(notification(), count)
+        self.assertEqual(u1.num_unread_messages, 0)
+
+        # Reading the messages resets it
+        with self.app.app_context():
+            response = reader.get('/messages')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hello 2', response.text)
+        db.session.expire_all()
+        self.assertEqual(u2.unread_message_count(), 0)
+        self.assertEqual(notification(), 0)
+
+    def test_last_seen_buffer(self):
+        long_ago = datetime(2000, 1, 1)
+        u1 = User(username='john', email='john@example.com',
+                  last_seen=long_ago)
+        u2 = User(username='susan', email='susan@example.com',
+                  last_seen=long_ago)
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        buffer = LastSeenBuffer()
+        buffer.app = self.app
+        buffer._ensure_flusher = lambda: None
+
+        # Visits are only buffered, and repeated ones are coalesced
+        buffer.touch(u1)
+        buffer.touch(u2)
+        buffer.touch(u1)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, long_ago)
+        self.assertEqual(buffer.flush(), 2)
+        db.session.expire_all()
+        self.assertGreater(u1.last_seen, long_ago)
+        self.assertGreater(u2.last_seen, long_ago)
+
+        # A fresh value is not written again inside the staleness window
+        buffer.touch(u1)
+        self.assertEqual(buffer.flush(), 0)
+
+    def test_post_list_rows(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='hello', author=u, language='en')
+        db.session.add(p)
+        db.session.commit()
+        for slots in (True, False):
+            self.app.config['POST_LIST_ROWS'] = slots
+            [row] = Post.list_rows(sa.select(Post))
+            self.assertEqual((row.id, row.body, row.language),
+                             (p.id, 'hello', 'en'))
+            self.assertEqual(row.author.username, 'john')
+            self.assertEqual(row.author.avatar(70), u.avatar(70))
+
+    def test_notification_upsert(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+
+        # Repeated notifications overwrite a single row
+        self.assertTrue(u.add_notification('unread_message_count', 1))
+        self.assertTrue(u.add_notification('unread_message_count', 2))
+        db.session.commit()
+        rows = db.session.scalars(u.notifications.select()).all()
+        self.assertEqual([n.get_data() for n in rows], [2])
+
+        # Throttled names drop writes that follow too closely
+        self.assertTrue(u.add_notification('task_progress', 10,
+                                           min_interval=60))
+        self.assertFalse(u.add_notification('task_progress', 20,
+                                            min_interval=60))
+        self.assertTrue(u.add_notification('task_progress', 100,
+                                           min_interval=0))
+        db.session.commit()
+        n = db.session.scalar(u.notifications.select().where(
+            Notification.name == 'task_progress'))
+        self.assertEqual(n.get_data(), 100)
+
+        # Old rows are purged
+        n.timestamp = 0
+        db.session.commit()
+        self.assertEqual(Notification.purge(3600), 1)
+        self.assertEqual(len(db.session.scalars(
+            u.notifications.select()).all()), 1)
+
+    def test_local_broker(self):
+        broker = LocalBroker()
+        subscription = broker.subscribe('notifications:1')
+        broker.publish('notifications:1', {'name': 'a'})
+        broker.publish('notifications:2', {'name': 'b'})
+        self.assertEqual(subscription.get(timeout=0.1), {'name': 'a'})
+        self.assertIsNone(subscription.get(timeout=0.01))
+
+        # A stalled subscriber drops events instead of blocking publishers
+        for i in range(150):
+            broker.publish('notifications:1', i)
+        self.assertEqual(subscription.queue.qsize(), 100)
+        subscription.close()
+        self.assertEqual(broker._subscribers, {})
+
+    def test_redis_broker(self):
+        redis = mock.Mock()
+        pubsub = redis.pubsub.return_value
+        broker = RedisBroker(redis)
+        self.assertTrue(broker.shared)
+        broker.publish('notifications:1', {'name': 'a', 'timestamp': 1.5})
+        redis.publish.assert_called_once_with(
+            'notifications:1', '{"name": "a", "timestamp": 1.5}')
+
+        subscription = broker.subscribe('notifications:1')
+        pubsub.subscribe.assert_called_once_with('notifications:1')
+        pubsub.get_message.return_value = {'data': '{"name": "a"}'}
+        self.assertEqual(subscription.get(timeout=1), {'name': 'a'})
+        pubsub.get_message.assert_called_with(timeout=1)
+        pubsub.get_message.return_value = None
+        self.assertIsNone(subscription.get(timeout=1))
+        subscription.close()
+        pubsub.close.assert_called_once_with()
+
+    def test_notification_stream(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        first = Notification.upsert(u.id, 'unread_message_count', 1) - 2
+        second = Notification.upsert(u.id, 'task_progress', 50) - 1
+        for name, timestamp in (('unread_message_count', first),
+                                ('task_progress', second)):
+            db.session.execute(sa.update(Notification).where(
+                Notification.name == name).values(timestamp=timestamp))
+        db.session.commit()
+        self.app.config.update(NOTIFICATIONS_STREAM_TIMEOUT=0.5,
+                               NOTIFICATIONS_HEARTBEAT=0.05)
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+        def events(chunks):
+            # Read up to the next heartbeat
+            found = []
+            for chunk in chunks:
+                if chunk.startswith(b': keep-alive'):
+                    return found
+                found.append(chunk.decode())
+
+        # The backlog after Last-Event-ID is replayed first
+        response = client.get('/notifications/stream',
+                              headers={'Last-Event-ID': str(first)})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = iter(response.response)
+        self.assertEqual(events(chunks), [
+            'retry: 10000\n\n',
+            f'id: {second}\nevent: task_progress\ndata: 50\n\n'])
+
+        # Rows stored by other processes are found in the database, since
+        # the in-process broker cannot see their messages
+        third = Notification.upsert(u.id, 'unread_message_count', 2)
+        db.session.commit()
+        self.assertEqual(events(chunks), [
+            f'id: {third}\nevent: unread_message_count\ndata: 2\n\n'])
+
+        # Published messages are forwarded as they arrive
+        self.app.notification_broker.publish(
+            Notification.channel(u.id),
+            {'name': 'task_progress', 'data': 100, 'timestamp': third + 1})
+        self.assertEqual(events(chunks), [
+            f'id: {third + 1}\nevent: task_progress\ndata: 100\n\n'])
+
+        # The stream ends after the timeout and frees its subscription
+        self.assertTrue(all(chunk == b': keep-alive\n\n' for chunk in chunks))
+        self.assertEqual(self.app.notification_streams.open, 1)
+        response.close()
+        self.assertEqual(self.app.notification_streams.open, 0)
+        self.assertEqual(self.app.notification_broker._subscribers, {})
+
+        # Past the limit browsers are told to poll instead
+        self.app.notification_streams.limit = 0
+        response = client.get('/notifications/stream')
+        self.assertEqual(response.status_code, 204)
+
+    def test_export_posts(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add_all([Post(body=f'post {i}', author=u,
+                                 timestamp=datetime(2024, 1, 1 + i))
+                            for i in range(5)])
+        db.session.add(Task(id='export-1', name='export_posts', user=u))
+        db.session.commit()
+        with tempfile.TemporaryDirectory() as folder:
+            self.app.config.update(EXPORT_FOLDER=folder, EXPORT_CHUNK_SIZE=2)
+            export_posts.apply(args=(u.id,), task_id='export-1')
+            with gzip.open(export_path(u.id), 'rt') as f:
+                posts = [json.loads(line) for line in f]
+        self.assertEqual([p['body'] for p in posts],
+                         [f'post {i}' for i in range(5)])
+        task = db.session.get(Task, 'export-1')
+        self.assertTrue(task.complete)
+        self.assertEqual(task.get_progress(), 100)
+
+        # Finished tasks are swept away
+        self.assertEqual(Task.sweep(), 1)
+        self.assertIsNone(db.session.get(Task, 'export-1'))
+
+    def test_export_posts_file_database(self):
+        # A file database gives the export and its progress updates
+        # separate connections, unlike the shared in-memory one
+        with tempfile.TemporaryDirectory() as folder:
+            class FileConfig(TestConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                    folder, 'app.db')
+                EXPORT_FOLDER = folder
+                EXPORT_CHUNK_SIZE = 100
+
+            app = create_app(FileConfig)
+            with app.app_context():
+                db.create_all()
+                u = User(username='john', email='john@example.com')
+                db.session.add(u)
+                db.session.flush()
+                start = datetime(2024, 1, 1)
+                db.session.execute(sa.insert(Post.__table__), [
+                    {'body': f'post {i}', 'user_id': u.id,
+                     'timestamp': start + timedelta(minutes=i // 2)}
+                    for i in range(1000)])
+                u.num_posts = 1000
+                db.session.add(Task(id='export-1', name='export_posts',
+                                    user=u))
+                db.session.commit()
+                export_posts.apply(args=(u.id,), task_id='export-1')
+                with gzip.open(export_path(u.id), 'rt') as f:
+                    posts = [json.loads(line) for line in f]
+                self.assertEqual([p['body'] for p in posts],
+                                 [f'post {i}' for i in range(1000)])
+                task = db.session.get(Task, 'export-1')
+                self.assertTrue(task.complete)
+                self.assertEqual(task.get_progress(), 100)
+                db.session.remove()
+                db.engine.dispose()
+
+    def test_mail_queue(self):
+        # A local SMTP server that records each connection's messages
+        class Handler(object):
+            def __init__(self):
+                self.sessions = {}
+
+            async def handle_DATA(self, server, session, envelope):
+                self.sessions.setdefault(id(session), []).append(
+                    envelope.rcpt_tos)
+                return '250 OK'
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        handler = Handler()
+        controller = Controller(handler, hostname='127.0.0.1', port=port)
+        controller.start()
+        self.addCleanup(controller.stop)
+
+        class MailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = port
+            MAIL_SUPPRESS_SEND = False
+            MAIL_WORKERS = 1
+
+        app = create_app(test_config=MailConfig)
+        queue = MailQueue(app)
+        # Hold the worker back until the whole burst is queued
+        queue._ensure_workers = lambda: None
+        with app.app_context():
+            for i in range(5):
+                msg = MailMessage('hi', sender='admin@example.com',
+                                  recipients=[f'user{i}@example.com'])
+                msg.body = 'hello'
+                self.assertTrue(queue.put(msg))
+            self.assertEqual(queue.stats()['depth'], 5)
+            with self.assertLogs(app.logger, 'INFO') as logs:
+                del queue._ensure_workers
+                queue._ensure_workers()
+                queue.queue.join()
+                # The batch is logged once its last message is out
+                deadline = time.monotonic() + 5
+                while not logs.records and time.monotonic() < deadline:
+                    time.sleep(0.01)
+        stats = queue.stats()
+        self.assertEqual((stats['depth'], stats['sent'], stats['failed']),
+                         (0, 5, 0))
+        self.assertGreater(stats['latency'], 0)
+        # Depth and latency are reported with every batch
+        self.assertRegex(logs.output[0],
+                         r'Sent 5 emails in [\d.]+s, [\d.]+s after queueing '
+                         r'on average; queue depth 0, 5 sent, 0 failed, '
+                         r'0 dropped, [\d.]+s average latency')
+        # The burst went out over a single SMTP connection
+        self.assertEqual(len(handler.sessions), 1)
+        self.assertEqual(len(next(iter(handler.sessions.values()))), 5)
+
+    def test_translate_posts(self):
+        class StubTranslator(Translator):
+            def translate(self, texts, source_language, dest_language):
+                return [f'{text} ({source_language}>{dest_language})'
+                        for text in texts]
+
+        self.app.translator = StubTranslator()
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='hola', author=u, language='es')
+        p2 = Post(body='hello', author=u)
+        p3 = Post(body='?!', author=u, language='')
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+        # Ids may come as numbers or numeric strings; posts without a
+        # language are skipped
+        response = client.post('/translate/batch', json={
+            'post_ids': [p1.id, str(p2.id), p3.id], 'dest_language': 'en'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['translations'],
+                         {str(p1.id): 'hola (es>en)'})
+
+        self.app.config['TRANSLATE_BATCH_LIMIT'] = 2
+        for body in ({'post_ids': [p1.id, p2.id, p3.id]},
+                     {'post_ids': str(p1.id)},
+                     {'post_ids': ['one']},
+                     {'post_ids': [[p1.id]]},
+                     {},
+                     [p1.id]):
+            response = client.post('/translate/batch', json=body)
+            self.assertEqual(response.status_code, 400, body)
+
+    def test_translation_cache(self):
+        class StubTranslator(Translator):
+            def __init__(self):
+                self.calls = 0
+                self.release = threading.Event()
+
+            def translate(self, texts, source_language, dest_language):
+                self.calls += 1
+                self.release.wait(5)
+                return [text.upper() for text in texts]
+
+        stub = self.app.translator = StubTranslator()
+
+        # Concurrent identical requests share one upstream call
+        def worker():
+            with self.app.app_context():
+                results.append(translate('hola', 'es', 'en'))
+
+        results = []
+        threads = [threading.Thread(target=worker) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        stub.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['HOLA'] * 3)
+        self.assertEqual(stub.calls, 1)
+
+        # Later requests are served from process memory, then the database
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.app.translation_cache.clear()
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(stub.calls, 1)
+        self.assertEqual(translate('hola', 'es', 'fr'), 'HOLA')
+        self.assertEqual(stub.calls, 2)
+
+        # Batches make one call per source language within the limits
+        stub.max_texts = 2
+        self.assertEqual(
+            translate_many([('hola', 'es'), ('uno', 'es'), ('dos', 'es'),
+                            ('tres', 'es'), ('un', 'fr')], 'en'),
+            ['HOLA', 'UNO', 'DOS', 'TRES', 'UN'])
+        self.assertEqual(stub.calls, 5)
+
+    def test_detect_post_language(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='hola como estas amigo mio', author=u)
+        db.session.add(p)
+        db.session.commit()
+        self.assertIsNone(p.language)
+        detect_post_language.apply(args=(p.id,))
+        db.session.expire_all()
+        self.assertEqual(p.language, 'es')
+        # The seeded detector always gives the same answer
+        self.assertEqual({detect_language('ok then') for _ in range(5)},
+                         {detect_language('ok then')})
+
+    def test_post_batch(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u2.follow(u1)
+        token = u1.get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'}
+        self.app.config['POST_BATCH_CHUNK_SIZE'] = 2
+
+        posts = [{'body': 'hola como estas amigo mio'},
+                 {'body': ''},
+                 {'body': 'good morning to all of you',
+                  'timestamp': '2020-01-02T03:04:05+02:00'},
+                 {'body': 'see you tomorrow my friend'}]
+        # No broker is needed to store the posts
+        with mock.patch('app.models.celery_app.send_task',
+                        side_effect=OSError):
+            response = client.post('/api/posts/batch', json={'posts': posts},
+                                   headers=headers)
+        self.assertEqual(response.status_code, 207)
+        items = response.json['items']
+        self.assertEqual([item['status'] for item in items],
+                         [201, 400, 201, 201])
+        self.assertEqual(response.json['_meta'], {'created': 3, 'failed': 1})
+        ids = [item['id'] for item in items if item['status'] == 201]
+        self.assertEqual(db.session.get(Post, ids[1]).timestamp,
+                         datetime(2020, 1, 2, 1, 4, 5))
+        db.session.expire_all()
+        self.assertEqual(u1.post_count(), 3)
+
+        # Each chunk recorded its follow-up work, handed on in one batch
+        self.assertEqual(db.session.scalars(
+            sa.select(Outbox.topic).order_by(Outbox.id)).all(),
+            ['language', 'fan_out'] * 2)
+        with mock.patch('app.models.celery_app.send_task') as send:
+            self.assertEqual(Outbox.drain(), 4)
+        self.assertEqual(send.call_args_list, [
+            mock.call('app.tasks.detect_post_languages', args=[ids],
+                      ignore_result=True),
+            mock.call('app.tasks.fan_out_posts', args=[ids],
+                      ignore_result=True)])
+        detect_post_languages.apply(args=(ids,))
+        fan_out_posts.apply(args=(ids,))
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Post, ids[0]).language, 'es')
+        self.assertEqual(set(self.home(u2)), set(ids))
+
+        response = client.post('/api/posts/batch', json={'posts': []},
+                               headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_token_cache(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        token = u.get_token()
+        db.session.commit()
+
+        # The first check reads the database, later ones the cache
+        self.assertEqual(User.check_token(token), u)
+        cached = User.check_token(token)
+        self.assertIsInstance(cached, TokenUser)
+        self.assertEqual(cached.id, u.id)
+        self.assertEqual(cached.username, 'john')
+
+        # Revoking or replacing a token evicts it once committed
+        u.revoke_token()
+        db.session.commit()
+        self.assertIsNone(User.check_token(token))
+        new_token = u.get_token()
+        db.session.commit()
+        self.assertEqual(User.check_token(new_token), u)
+        self.assertIsNone(User.check_token(token))
+
+    def test_password_hash_limit(self):
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(password_hasher.stats()['outstanding'], 0)
+
+        # Requests that hash report the queue and hash times
+        auth = base64.b64encode(b'susan:cat').decode()
+        response = self.app.test_client().post(
+            '/api/tokens/', headers={'Authorization': 'Basic ' + auth})
+        self.assertEqual(response.status_code, 200)
+        report = dict(item.split('=') for item in
+                      response.headers['X-Password-Hash'].split('; '))
+        self.assertEqual(set(report), {
+            'queue-time', 'hash-time', 'avg-queue-time', 'avg-hash-time',
+            'outstanding', 'rejected'})
+        self.assertGreater(float(report['hash-time']), 0)
+        self.assertEqual(report['outstanding'], '0')
+        response = self.app.test_client().get('/api/users/1')
+        self.assertNotIn('X-Password-Hash', response.headers)
+
+        # Past the queue limit hashing is refused straight away
+        self.app.config['PASSWORD_HASH_QUEUE'] = 0
+        with self.assertRaises(PasswordHashBusy):
+            u.check_password('cat')
+        response = self.app.test_client().post(
+            '/api/tokens/', headers={'Authorization': 'Basic ' + auth})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json['error'], 'Service Unavailable')
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(password_hasher.stats()['rejected'], 2)
+        self.assertIn('rejected=2', response.headers['X-Password-Hash'])
+
+        # Retry-After is taken from the exception, for pages too
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        with mock.patch.object(User, 'check_password',
+                               side_effect=PasswordHashBusy(retry_after=5)):
+            response = self.app.test_client().post(
+                '/login', headers={'Accept': 'text/html'},
+                data={'username': 'susan', 'password': 'cat'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.mimetype, 'text/html')
+        self.assertEqual(response.headers['Retry-After'], '5')
+
+    def test_per_process(self):
+        started = []
+        worker = PerProcess(lambda: started.append(os.getpid()) or
+                            len(started))
+        self.assertEqual(worker.get(), 1)
+        self.assertEqual(worker.get(), 1)
+        # A forked child starts its own
+        with mock.patch('app.background.os.getpid', return_value=-1):
+            self.assertEqual(worker.get(), 2)
+            self.assertEqual(worker.get(), 2)
+
+    def test_user_collection_queries(self):
+        target = User(username='john', email='john@example.com')
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(30)]
+        db.session.add_all([target] + users)
+        db.session.commit()
+        for u in users:
+            u.follow(target)
+        token = target.get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'}
+
+        # Warm the token cache first
+        client.get(f'/api/users/{target.id}', headers=headers)
+
+        # The number of queries does not depend on the page size
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        sa.event.listen(db.engine, 'before_cursor_execute', count)
+        self.addCleanup(sa.event.remove, db.engine, 'before_cursor_execute',
+                        count)
+        queries = []
+        for per_page in (5, 30):
+            statements.clear()
+            response = client.get(
+                f'/api/users/{target.id}/followers?per_page={per_page}',
+                headers=headers)
+            self.assertEqual(len(response.json['items']), per_page)
+            self.assertEqual(response.json['items'][0]['follower_count'], 0)
+            self.assertEqual(response.json['items'][0]['following_count'], 1)
+            queries.append(len(statements))
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(response.json['items'][0]['_links']['self'],
+                         f'/api/users/{users[0].id}')
+
+    def test_user_fieldsets(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        token = u1.get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'}
+
+        response = client.get('/api/users/?fields=id,username',
+                              headers=headers)
+        self.assertEqual(response.json['items'],
+                         [{'id': u1.id, 'username': 'john'},
+                          {'id': u2.id, 'username': 'susan'}])
+        self.assertIn('fields=id,username',
+                      response.json['_links']['self'])
+
+        # Email can only be expanded on the caller's own user
+        response = client.get(f'/api/users/{u1.id}?fields=id&expand=email',
+                              headers=headers)
+        self.assertEqual(response.json,
+                         {'id': u1.id, 'email': 'john@example.com'})
+        response = client.get(f'/api/users/{u2.id}?expand=email',
+                              headers=headers)
+        self.assertEqual(response.status_code, 400)
+        response = client.get('/api/users/?fields=password_hash',
+                              headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_conditional_get(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        token = u1.get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'}
+
+        response = client.get(f'/api/users/{u2.id}', headers=headers)
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        response = client.get(f'/api/users/{u2.id}', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        response = client.get(f'/api/users/{u2.id}?fields=id', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+
+        # Follows and profile edits invalidate it
+        u1.follow(u2)
+        db.session.commit()
+        response = client.get(f'/api/users/{u2.id}', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        u2.about_me = 'Hello'
+        db.session.commit()
+        response = client.get(f'/api/users/{u2.id}', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['about_me'], 'Hello')
+
+        # Collections are tagged from the versions of their items, which
+        # are read before, and instead of, the full rows
+        response = client.get('/api/users/', headers=headers)
+        etag = response.headers['ETag']
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        sa.event.listen(db.engine, 'before_cursor_execute', record)
+        self.addCleanup(sa.event.remove, db.engine, 'before_cursor_execute',
+                        record)
+        response = client.get('/api/users/', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertTrue(statements)
+        self.assertFalse([statement for statement in statements
+                          if 'user.about_me' in statement])
+
+        # A new member or a changed one gives the page a new tag
+        u2.about_me = 'Hello again'
+        u2.version += 1
+        db.session.commit()
+        response = client.get('/api/users/', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['items']), 2)
+        db.session.add(User(username='mary', email='mary@example.com'))
+        db.session.commit()
+        response = client.get('/api/users/', headers=dict(
+            headers, **{'If-None-Match': response.headers['ETag']}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['items']), 3)
+
+    def test_ndjson_collection(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(25)]
+        db.session.add_all(users)
+        db.session.commit()
+        token = users[0].get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token}',
+                   'Accept': 'application/x-ndjson'}
+        self.assertIsInstance(self.app.json, OrjsonProvider)
+
+        # Pages larger than the JSON limit are streamed a line per item
+        self.app.config['API_STREAM_CHUNK_SIZE'] = 7
+        response = client.get('/api/users/?per_page=20&fields=id',
+                              headers=headers)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual(lines[:-1], [{'id': u.id} for u in users[:20]])
+        self.assertEqual(lines[-1]['_meta'], {'per_page': 20, 'count': 20})
+        response = client.get(lines[-1]['_links']['next'], headers=headers)
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([line['id'] for line in lines[:-1]],
+                         [u.id for u in users[20:]])
+        self.assertIsNone(lines[-1]['_links']['next'])
+
+        # The document representation is unchanged
+        response = client.get('/api/users/?per_page=20', headers=dict(
+            headers, Accept='application/json'))
+        self.assertEqual(len(response.json['items']), 20)
+        self.assertEqual(response.json['items'][0]['username'], 'user0')
+
+        # Page sizes below one are raised to one item
+        for per_page in (0, -5):
+            response = client.get(f'/api/users/?per_page={per_page}',
+                                  headers=dict(headers,
+                                               Accept='application/json'))
+            self.assertEqual(len(response.json['items']), 1)
+            self.assertEqual(response.json['_meta']['per_page'], 1)
+            response = client.get(f'/api/users/?per_page={per_page}',
+                                  headers=headers)
+            lines = [json.loads(line) for line in response.text.splitlines()]
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(lines[-1]['_meta'], {'per_page': 1, 'count': 1})
+
+    def test_new_post_outbox(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u2.follow(u1)
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+        topics = sa.select(Outbox.topic).order_by(Outbox.id)
+
+        # The post is stored, and its follow-up work recorded, even when
+        # the broker cannot be reached
+        with mock.patch('app.models.celery_app.send_task',
+                        side_effect=OSError) as send:
+            response = client.post(
+                '/index', data={'post': 'hola como estas amigo mio'})
+            self.assertEqual(response.status_code, 302)
+            send.assert_called_once_with('app.tasks.drain_outbox',
+                                         ignore_result=True)
+            post = db.session.scalar(sa.select(Post))
+            self.assertEqual(db.session.scalars(topics).all(),
+                             ['language', 'fan_out'])
+
+            # A failed hand-off leaves the entries for the next drain
+            with self.assertRaises(OSError):
+                Outbox.drain()
+            db.session.rollback()
+            self.assertEqual(len(db.session.scalars(topics).all()), 2)
+
+        with mock.patch('app.models.celery_app.send_task') as send:
+            self.assertEqual(Outbox.drain(), 2)
+        self.assertEqual(db.session.scalars(topics).all(), [])
+        self.assertEqual(send.call_args_list, [
+            mock.call('app.tasks.detect_post_languages', args=[[post.id]],
+                      ignore_result=True),
+            mock.call('app.tasks.fan_out_posts', args=[[post.id]],
+                      ignore_result=True)])
+        for call in send.call_args_list:
+            self.app.extensions['celery'].tasks[call.args[0]].apply(
+                args=call.kwargs['args'])
+        db.session.expire_all()
+        self.assertEqual(post.language, 'es')
+        self.assertEqual(self.home(u2), [post.id])
+
+    def test_search_outbox(self):
+        # Pretend an external search service is configured
+        self.app.search = ElasticsearchBackend(client=None)
+        outbox_size = sa.select(sa.func.count()).select_from(Outbox)
+        with mock.patch.object(Outbox, 'dispatch') as dispatch, \
+                mock.patch('app.models.bulk_update_index') as bulk:
+            u = User(username='john', email='john@example.com')
+            db.session.add(u)
+            db.session.commit()
+            dispatch.assert_not_called()
+            self.assertEqual(db.session.scalar(outbox_size), 0)
+
+            p = Post(body='hello', author=u)
+            db.session.add(p)
+            db.session.commit()
+            dispatch.assert_called_once()
+            self.assertEqual(db.session.scalar(outbox_size), 1)
+
+            self.assertEqual(Outbox.drain(), 1)
+            bulk.assert_called_once_with('post', {p.id: {'body': 'hello'}},
+                                         [])
+            self.assertEqual(db.session.scalar(outbox_size), 0)
+
+    def test_database_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        p2 = Post(body='a lazy dog', author=u)
+        p3 = Post(body='quick thinking', author=u)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        posts, total = Post.search('quick', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual({post.id for post in posts}, {p1.id, p3.id})
+        posts, total = Post.search('fox OR "dog"', 1, 10)
+        self.assertEqual(total, 2)
+
+        # Edits and deletes are reflected once cached results expire
+        p1.body = 'slow'
+        db.session.delete(p3)
+        db.session.commit()
+        self.assertEqual(Post.search('quick', 1, 10)[1], 2)
+        self.app.search_cache.clear()
+        self.assertEqual(Post.search('quick', 1, 10), ([], 0))
+
+    def test_database_reindex(self):
+        # The chunks are indexed from worker threads, which need a file
+        # database to see the rows committed here
+        with tempfile.TemporaryDirectory() as folder:
+            class FileConfig(TestConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                    folder, 'app.db')
+
+            app = create_app(FileConfig)
+            with app.app_context():
+                db.create_all()
+                u = User(username='john', email='john@example.com')
+                db.session.add(u)
+                db.session.flush()
+                # Core inserts bypass after_flush, so nothing is indexed yet
+                db.session.execute(sa.insert(Post.__table__), [
+                    {'body': f'fox {i}', 'user_id': u.id,
+                     'timestamp': datetime(2024, 1, 1)}
+                    for i in range(250)])
+                db.session.commit()
+                self.assertEqual(Post.search('fox', 1, 10), ([], 0))
+                app.search_cache.clear()
+
+                # Rows created while the chunks are being indexed are
+                # caught up before the new index is swapped in, and edits
+                # to rows already indexed reach the new index too
+                done = []
+
+                def progress(total):
+                    if not done:
+                        self.assertTrue(db.session.scalar(
+                            sa.select(SearchReindex.target)
+                            .where(SearchReindex.alias == 'post')
+                        ).startswith('post-'))
+                        db.session.execute(sa.insert(Post.__table__), [
+                            {'body': f'dog {i}', 'user_id': u.id,
+                             'timestamp': datetime(2024, 1, 2)}
+                            for i in range(20)])
+                        db.session.get(Post, 1).body = 'cat'
+                        db.session.delete(db.session.get(Post, 2))
+                        db.session.commit()
+                    done.append(total)
+
+                total = Post.reindex(chunk_size=40, workers=3,
+                                     progress=progress)
+                self.assertEqual(total, 270)
+                self.assertEqual(len(done), 7)
+                self.assertEqual(done[-1], 250)
+                self.assertEqual(Post.search('fox', 1, 10)[1], 248)
+                self.assertEqual(Post.search('dog', 1, 10)[1], 20)
+                self.assertEqual(Post.search('cat', 1, 10)[1], 1)
+                self.assertIsNone(db.session.get(SearchReindex, 'post'))
+                # The versioned index was renamed over the live one
+                self.assertEqual(
+                    [table for table in sa.inspect(db.engine).get_table_names()
+                     if table.startswith('post') and
+                     table.endswith('_fts')], ['post_fts'])
+
+                # Writes keep going to the swapped-in index
+                db.session.add(Post(body='quick cat', author=u))
+                db.session.commit()
+                app.search_cache.clear()
+                self.assertEqual(Post.search('cat', 1, 10)[1], 2)
+                db.session.remove()
+
+            # The command runs in the current app context, which must be
+            # this app's rather than the one set up for the test case
+            with app.app_context():
+                result = app.test_cli_runner().invoke(
+                    args=['search', 'reindex', '--chunk-size', '100', 'post'])
+                self.assertEqual(result.exit_code, 0, result.output)
+                self.assertIn('post: indexed 270 rows', result.output)
+                self.assertEqual(Post.search('fox', 1, 10)[1], 248)
+                self.assertEqual(Post.search('cat', 1, 10)[1], 2)
+                db.session.remove()
+                db.engine.dispose()
+
+    def test_search_result_cache(self):
+        cache = ResultCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # 'b' was the least recently used entry
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+        cache.ttl = 0
+        cache.set('d', 4)
+        self.assertIsNone(cache.get('d'))
+
+    def test_keyset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u, timestamp=now)
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        keys = [Post.timestamp, Post.id]
+
+        # Walk forward through the feed, then back again
+        page1 = keyset_paginate(sa.select(Post), keys, 2)
+        self.assertEqual(page1.items, posts[:-3:-1])
+        self.assertIsNone(page1.prev_args)
+        page2 = keyset_paginate(sa.select(Post), keys, 2,
+                                **page1.next_args)
+        self.assertEqual(page2.items, posts[2:0:-1])
+        page3 = keyset_paginate(sa.select(Post), keys, 2,
+                                **page2.next_args)
+        self.assertEqual(page3.items, [posts[0]])
+        self.assertIsNone(page3.next_args)
+        back = keyset_paginate(sa.select(Post), keys, 2,
+                               **page3.prev_args)
+        self.assertEqual(back.items, page2.items)
+
+        # A garbled cursor falls back to the first page
+        bad = keyset_paginate(sa.select(Post), keys, 2, before='garbage')
+        self.assertEqual(bad.items, page1.items)
 
 
 if __name__ == '__main__':